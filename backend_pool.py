@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+import requests
+from aiohttp import ClientError, ClientSession, ClientTimeout
+
+log = logging.getLogger(__name__)
+
+DEFAULT_HEALTH_INTERVAL = 10
+DEFAULT_HEALTH_TIMEOUT = 5
+
+# Cheap endpoints that answer without running inference, tried in order until one exists
+HEALTH_PATHS = {
+    "llama.cpp": ["/health", "/slots"],
+    "kobold.cpp": ["/api/extra/version", "/api/v1/model"],
+    "openai": ["/health", "/v1/models"],
+}
+
+
+class NoHealthyBackend(Exception):
+    pass
+
+
+class Backend:
+    """One llama.cpp, kobold.cpp or OpenAI compatible server and what we know about its health and load"""
+
+    def __init__(self, url: str, mode: str):
+        if mode not in HEALTH_PATHS:
+            raise ValueError(f"Unknown backend mode {mode}, expected one of {', '.join(HEALTH_PATHS)}")
+        self.url = url.rstrip("/")
+        self.mode = mode
+        self.healthy = True
+        self.outstanding = 0
+        self.last_error = None
+
+    @classmethod
+    def from_spec(cls, spec: str, default_mode: str) -> "Backend":
+        """Parses "http://host:8080" or "kobold.cpp@http://host:5001" """
+        mode, separator, url = spec.strip().rpartition("@")
+        if not separator or mode not in HEALTH_PATHS:
+            return cls(spec.strip(), default_mode)
+        return cls(url, mode)
+
+    def update_health(self, status: int) -> None:
+        # llama.cpp answers 503 while the model is still loading
+        was_healthy = self.healthy
+        self.healthy = status == 200
+        self.last_error = None if self.healthy else f"HTTP Response: {status}"
+        if was_healthy != self.healthy:
+            log.warning(f"Backend {self.url} is now {'healthy' if self.healthy else 'unhealthy'}")
+
+    def mark_failed(self, exn: Exception) -> None:
+        if self.healthy:
+            log.warning(f"Backend {self.url} failed and is taken out of rotation until its next health check: {exn!r}")
+        self.healthy = False
+        self.last_error = repr(exn)
+
+    def __repr__(self):
+        return f"<Backend {self.mode}@{self.url} healthy={self.healthy} outstanding={self.outstanding}>"
+
+
+class BackendPool:
+    """
+    Routes generations across several backends. A JID sticks to the backend that served it last so the prompt cache
+    on that server stays warm, new or displaced JIDs go to the healthy backend with the fewest requests in flight.
+    """
+
+    def __init__(self, backends: list[Backend], health_interval: float = DEFAULT_HEALTH_INTERVAL):
+        if not backends:
+            raise ValueError("At least one backend host is required")
+        self.backends = backends
+        self.health_interval = health_interval
+        self.affinity = {}
+        self._health_task = None
+
+    @classmethod
+    def from_hosts(cls, hosts: str, default_mode: str, **kwargs) -> "BackendPool":
+        """Builds a pool from a comma separated --api-host value"""
+        return cls([Backend.from_spec(spec, default_mode) for spec in hosts.split(",") if spec.strip()], **kwargs)
+
+    def pick(self, key: str, exclude: tuple = ()) -> Backend:
+        candidates = [backend for backend in self.backends if backend.healthy and backend not in exclude]
+        if not candidates:
+            raise NoHealthyBackend("ERROR: NO HEALTHY BACKEND IS AVAILABLE. " +
+                                   "; ".join(f"{backend.url}: {backend.last_error}" for backend in self.backends))
+        backend = self.affinity.get(key)
+        if backend not in candidates:
+            backend = min(candidates, key=lambda candidate: candidate.outstanding)
+            self.affinity[key] = backend
+        return backend
+
+    @asynccontextmanager
+    async def acquire(self, key: str, exclude: tuple = ()):
+        backend = self.pick(key, exclude)
+        backend.outstanding += 1
+        try:
+            yield backend
+        finally:
+            backend.outstanding -= 1
+
+    async def check(self, backend: Backend, http_session: ClientSession) -> None:
+        try:
+            # Older servers lack some of the endpoints, a 404 moves on to the next one
+            for path in HEALTH_PATHS[backend.mode]:
+                async with http_session.get(backend.url + path,
+                                            timeout=ClientTimeout(total=DEFAULT_HEALTH_TIMEOUT)) as response:
+                    if response.status != 404:
+                        break
+            backend.update_health(response.status)
+        except (ClientError, asyncio.TimeoutError) as exn:
+            backend.mark_failed(exn)
+
+    async def check_all(self, http_session: ClientSession) -> None:
+        await asyncio.gather(*[self.check(backend, http_session) for backend in self.backends])
+
+    async def run_health_checks(self, http_session: ClientSession) -> None:
+        while True:
+            await self.check_all(http_session)
+            await asyncio.sleep(self.health_interval)
+
+    def start_health_checks(self, http_session: ClientSession) -> None:
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.ensure_future(self.run_health_checks(http_session))
+
+    def check_all_blocking(self) -> bool:
+        """Startup probe for use before the event loop runs, True if any backend is healthy"""
+        for backend in self.backends:
+            try:
+                for path in HEALTH_PATHS[backend.mode]:
+                    response = requests.get(backend.url + path, timeout=DEFAULT_HEALTH_TIMEOUT)
+                    if response.status_code != 404:
+                        break
+                backend.update_health(response.status_code)
+            except requests.RequestException as exn:
+                backend.mark_failed(exn)
+        return any(backend.healthy for backend in self.backends)
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import gc
+import json
+import logging
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+
+from slixmpp import JID
+
+import harness
+import tts_middleware
+from stub_backend import StubBackend, DEFAULT_STUB_TOKENS, DEFAULT_STUB_TOKEN_RATE, DEFAULT_STUB_LATENCY
+from xmppbot import XMPPBot, LlamaCppAPIClient, chat_to_prompt, DEFAULT_CONFIG_PATH
+
+log = logging.getLogger(__name__)
+
+DEFAULT_ITERATIONS = 200
+DEFAULT_CONCURRENCY = 8
+DEFAULT_SESSIONS = 50
+DEFAULT_TURNS = 4
+DEFAULT_FORMAT = "chatml"
+DEFAULT_TTS_ITERATIONS = 5
+BENCH_PROMPT = "Tell me something about llamas."
+BENCH_REPLY = ("Llamas are social animals... They live in herds! Did you know they hum? "
+               "They were domesticated in the Andes - about 5000 years ago. \"Llama\" is a Spanish word. ") * 8
+
+
+def summarize(latencies: list[float], elapsed: float, **extra) -> dict:
+    return dict({
+        "iterations": len(latencies),
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_p50": harness.percentile(latencies, 50),
+        "latency_p99": harness.percentile(latencies, 99),
+        "latency_max": max(latencies, default=0.0),
+    }, **extra)
+
+
+def time_sync(function, iterations: int) -> dict:
+    """For CPU bound code, calls function back to back"""
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        call_start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter() - call_start)
+    return summarize(latencies, time.perf_counter() - start)
+
+
+async def time_async(function, iterations: int, concurrency: int) -> dict:
+    """Runs `iterations` calls of a coroutine function with at most `concurrency` of them in flight"""
+    latencies = []
+    remaining = iter(range(iterations))
+
+    async def worker():
+        for _ in remaining:
+            call_start = time.perf_counter()
+            await function()
+            latencies.append(time.perf_counter() - call_start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return summarize(latencies, time.perf_counter() - start, concurrency=concurrency)
+
+
+def make_bot(config_path: str, mode: str, api_host: str) -> XMPPBot:
+    return XMPPBot(jid="bench@example.com", password="", room=None, nick=None, config_path=config_path, mode=mode,
+                   api_host=api_host, dry_run=True, tts=None, voice_only=False, echo_bot_mode=False)
+
+
+async def bench_api_call(bot: XMPPBot, iterations: int, concurrency: int) -> dict:
+    """Full turns through XMPPBot.api_call, one synthetic user per concurrent conversation"""
+    outcome = await harness.replay(bot, [(None, BENCH_PROMPT)] * iterations, concurrency)
+    summary = outcome["summary"]
+    latencies = [result["latency"] for result in outcome["results"] if result["error"] is None]
+    return summarize(latencies, summary["elapsed"], concurrency=concurrency, errors=summary["errors"])
+
+
+async def bench_stream_completion(url: str, iterations: int, concurrency: int) -> dict:
+    client = LlamaCppAPIClient(base_url=url)
+    chat_thread = [{"role": "system", "content": "You are a helpful assistant."},
+                   {"role": "user", "content": BENCH_PROMPT}]
+
+    async def completion():
+        async for response in client.stream_completion(chat_thread, DEFAULT_FORMAT):
+            if response.get("stop"):
+                break
+
+    return await time_async(completion, iterations, concurrency)
+
+
+def bench_chat_to_prompt(iterations: int, turns: int) -> dict:
+    chat_thread = [{"role": "system", "content": "You are a helpful assistant."}]
+    for _ in range(turns):
+        chat_thread.append({"role": "user", "content": BENCH_PROMPT})
+        chat_thread.append({"role": "assistant", "content": BENCH_REPLY})
+    return dict(time_sync(lambda: chat_to_prompt(chat_thread, DEFAULT_FORMAT), iterations), turns=turns)
+
+
+def bench_tts_text(iterations: int) -> dict:
+    processor = tts_middleware.TTSTextProcessor()
+
+    def process():
+        processor.split_text(processor.preprocess_text(BENCH_REPLY, tts_middleware.default_rule_list))
+
+    return dict(time_sync(process, iterations), chars=len(BENCH_REPLY))
+
+
+def bench_tts_rtf(voice: str, iterations: int, threads: int | None) -> dict:
+    """
+    Real-time factor of XTTS on the CPU, synthesis seconds per second of speech, for the float model and the int8
+    quantized one, and how long streaming synthesis takes to its first chunk. Sampling is seeded the same for both
+    so they speak comparable lengths.
+    """
+    import torch
+
+    processor = tts_middleware.TTSTextProcessor()
+    sentences = processor.split_text(processor.preprocess_text(BENCH_REPLY, tts_middleware.default_rule_list))
+    sentences = sentences[:iterations]
+    result = {"sentences": len(sentences), "threads": torch.get_num_threads() if threads is None else threads}
+    for variant, quantize in (("float", False), ("int8", True)):
+        controller = tts_middleware.TTSAudioController(device="cpu", quantize=quantize, threads=threads,
+                                                       warm_up_speaker=voice)
+        torch.manual_seed(0)
+        latencies = []
+        audio = 0.0
+        for sentence in sentences:
+            start = time.perf_counter()
+            waveform = controller.synthesize(sentence, [voice])
+            latencies.append(time.perf_counter() - start)
+            audio += len(waveform) / controller.mixer.sample_rate
+        first_chunks = []
+        for sentence in sentences:
+            start = time.perf_counter()
+            for _ in controller.stream(sentence, [voice]):
+                first_chunks.append(time.perf_counter() - start)
+                break
+        result[variant] = summarize(latencies, sum(latencies), audio_seconds=audio,
+                                    rtf=sum(latencies) / audio if audio else 0.0,
+                                    first_chunk_p50=harness.percentile(first_chunks, 50))
+        del controller
+        gc.collect()
+    result["speedup"] = result["float"]["rtf"] / result["int8"]["rtf"] if result["int8"]["rtf"] else 0.0
+    return result
+
+
+async def bench_http_request(bot: XMPPBot, url: str, iterations: int) -> dict:
+    return await time_async(lambda: bot.http_request(url), iterations, 1)
+
+
+async def bench_session_memory(bot: XMPPBot, sessions: int, turns: int) -> dict:
+    """Memory still held once `sessions` users have each had `turns` turns, divided per user"""
+    prompts = [(f"memory{index}@{harness.SYNTHETIC_DOMAIN}", BENCH_PROMPT)
+               for index in range(sessions) for _ in range(turns)]
+    gc.collect()
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        await harness.replay(bot, prompts)
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "sessions": sessions,
+        "turns": turns,
+        "bytes_per_session": (current - baseline) / sessions,
+        "peak_bytes": peak - baseline,
+        "prompt_chars_per_session": sum(len(bot.user_sessions[JID(jid).bare]["prompt"])
+                                        for jid in {jid for jid, _ in prompts}) / sessions,
+    }
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run_benchmarks(args) -> dict:
+    stub = StubBackend(tokens=args.tokens, token_rate=args.token_rate, latency=args.latency)
+    url = await stub.start()
+    scenarios = {}
+    bots = []
+    try:
+        for mode in ("llama.cpp", "kobold.cpp", "openai"):
+            bot = make_bot(args.system_prompt, mode, url)
+            bots.append(bot)
+            log.info(f"api_call[{mode}]")
+            scenarios[f"api_call[{mode}]"] = await bench_api_call(bot, args.iterations, args.concurrency)
+
+        log.info("stream_completion")
+        scenarios["stream_completion"] = await bench_stream_completion(url, args.iterations, args.concurrency)
+        log.info("chat_to_prompt")
+        scenarios["chat_to_prompt"] = bench_chat_to_prompt(args.iterations, args.turns)
+        log.info("tts_text_processor")
+        scenarios["tts_text_processor"] = bench_tts_text(args.iterations)
+        log.info("http_request")
+        scenarios["http_request"] = await bench_http_request(bots[0], url + "/page", args.iterations)
+
+        bot = make_bot(args.system_prompt, "llama.cpp", url)
+        bots.append(bot)
+        log.info("session_memory")
+        scenarios["session_memory"] = await bench_session_memory(bot, args.sessions, args.turns)
+
+        if args.tts_rtf is not None:
+            log.info("tts_rtf")
+            scenarios["tts_rtf"] = bench_tts_rtf(args.tts_rtf, args.tts_iterations, args.tts_threads)
+    finally:
+        for bot in bots:
+            if bot.http_session is not None:
+                await bot.http_session.close()
+        await stub.stop()
+
+    return {
+        "revision": git_revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            "iterations": args.iterations,
+            "concurrency": args.concurrency,
+            "sessions": args.sessions,
+            "turns": args.turns,
+            "tokens": args.tokens,
+            "token_rate": args.token_rate,
+            "latency": args.latency,
+            "system_prompt": args.system_prompt,
+            "tts_rtf": args.tts_rtf,
+        },
+        "scenarios": scenarios,
+    }
+
+
+def report(results: dict) -> None:
+    for name, scenario in results["scenarios"].items():
+        if "latency_p50" in scenario:
+            log.info(f"{name:<24} {scenario['throughput']:>10.1f}/s  p50 {scenario['latency_p50'] * 1000:>8.2f}ms  "
+                     f"p99 {scenario['latency_p99'] * 1000:>8.2f}ms")
+        elif "speedup" in scenario:
+            log.info(f"{name:<24} float RTF {scenario['float']['rtf']:.3f}  int8 RTF {scenario['int8']['rtf']:.3f}  "
+                     f"speedup {scenario['speedup']:.2f}x on {scenario['threads']} threads  first chunk "
+                     f"{scenario['float']['first_chunk_p50'] * 1000:.0f}ms / "
+                     f"{scenario['int8']['first_chunk_p50'] * 1000:.0f}ms")
+        else:
+            log.info(f"{name:<24} {scenario['bytes_per_session'] / 1024:>10.1f}KiB per session  "
+                     f"peak {scenario['peak_bytes'] / 1024:.1f}KiB")
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Benchmark the bot against a local stub llama.cpp / kobold.cpp server")
+    parser.add_argument("-q", "--quiet", help="set logging to ERROR",
+                        action="store_const", dest="loglevel",
+                        const=logging.ERROR, default=logging.INFO)
+    parser.add_argument("-s", "--system-prompt", dest="system_prompt",
+                        help="Backend JSON profile defaults to %s" % DEFAULT_CONFIG_PATH,
+                        default=DEFAULT_CONFIG_PATH)
+    parser.add_argument("-o", "--output", dest="output",
+                        help="Write the results as JSON to this file, - for stdout. Defaults to stdout",
+                        default="-")
+    parser.add_argument("--iterations", dest="iterations", type=int,
+                        help="Calls per scenario. Defaults to %d" % DEFAULT_ITERATIONS,
+                        default=DEFAULT_ITERATIONS)
+    parser.add_argument("--concurrency", dest="concurrency", type=int,
+                        help="Calls in flight at once in the network scenarios. Defaults to %d" % DEFAULT_CONCURRENCY,
+                        default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--sessions", dest="sessions", type=int,
+                        help="Users in the memory scenario. Defaults to %d" % DEFAULT_SESSIONS,
+                        default=DEFAULT_SESSIONS)
+    parser.add_argument("--turns", dest="turns", type=int,
+                        help="Turns per user in the memory and chat_to_prompt scenarios. Defaults to %d"
+                             % DEFAULT_TURNS,
+                        default=DEFAULT_TURNS)
+    parser.add_argument("--tokens", dest="tokens", type=int,
+                        help="Tokens in every stub response. Defaults to %d" % DEFAULT_STUB_TOKENS,
+                        default=DEFAULT_STUB_TOKENS)
+    parser.add_argument("--token-rate", dest="token_rate", type=float,
+                        help="Stub tokens per second. Defaults to %d" % DEFAULT_STUB_TOKEN_RATE,
+                        default=DEFAULT_STUB_TOKEN_RATE)
+    parser.add_argument("--latency", dest="latency", type=float,
+                        help="Seconds before the stub's first token. Defaults to %g" % DEFAULT_STUB_LATENCY,
+                        default=DEFAULT_STUB_LATENCY)
+    parser.add_argument("--tts-rtf", dest="tts_rtf",
+                        help="Also measure the real-time factor of the voice model on the CPU, float against int8, "
+                             "cloning this .wav file",
+                        default=None)
+    parser.add_argument("--tts-iterations", dest="tts_iterations", type=int,
+                        help="Sentences synthesized per variant in the real-time factor scenario. Defaults to %d"
+                             % DEFAULT_TTS_ITERATIONS,
+                        default=DEFAULT_TTS_ITERATIONS)
+    parser.add_argument("--tts-threads", dest="tts_threads", type=int,
+                        help="Threads for the voice model in the real-time factor scenario. Defaults to one per core",
+                        default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=args.loglevel, format='%(levelname)-8s %(message)s', stream=sys.stderr)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = loop.run_until_complete(run_benchmarks(args))
+    report(results)
+    if args.output == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
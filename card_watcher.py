@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import logging
+import os
+
+from prompt_templates import PromptTemplate, load_template
+
+log = logging.getLogger(__name__)
+
+DEFAULT_RELOAD_INTERVAL = 2.0
+# Fields every card needs and the types they must have, anything else is passed to the backend as is
+REQUIRED_FIELDS = {"prompt": str, "max_context_length": int}
+NUMERIC_FIELDS = ("max_length", "temperature", "min_p", "top_p", "top_k", "typical", "tfs", "rep_pen",
+                  "rep_pen_range", "rep_pen_slope")
+
+
+class CardError(ValueError):
+    pass
+
+
+def load_card(path: str) -> tuple[dict, PromptTemplate]:
+    """Reads and validates a character card, raises CardError if it can not be used"""
+    try:
+        with open(path, "r") as file:
+            card = json.load(file)
+    except (OSError, ValueError) as exn:
+        raise CardError(f"Could not read {path}: {exn}") from exn
+    if not isinstance(card, dict):
+        raise CardError(f"{path} does not contain a JSON object")
+    for field, kind in REQUIRED_FIELDS.items():
+        if not isinstance(card.get(field), kind):
+            raise CardError(f"{path} needs a {field} of type {kind.__name__}")
+    for field in NUMERIC_FIELDS:
+        if field in card and (isinstance(card[field], bool) or not isinstance(card[field], (int, float))):
+            raise CardError(f"{field} in {path} is not a number")
+    try:
+        template = load_template(card)
+    except (ValueError, KeyError, TypeError) as exn:
+        raise CardError(f"{path} has no usable prompt template: {exn}") from exn
+    return card, template
+
+
+class CardWatcher:
+    """
+    Polls the character card file and hands every new version that validates to apply(card, template). A version
+    that does not validate is logged and the card in use is kept. Polling the modification time needs nothing from
+    the platform and costs one stat per interval.
+    """
+
+    def __init__(self, path: str, apply, interval: float = DEFAULT_RELOAD_INTERVAL):
+        self.path = path
+        self.apply = apply
+        self.interval = interval
+        self.signature = self.stat()
+        self._task = None
+
+    def stat(self) -> tuple | None:
+        try:
+            status = os.stat(self.path)
+        except OSError:
+            return None
+        return status.st_mtime_ns, status.st_size
+
+    def check(self) -> bool:
+        """Reloads the card if the file changed since the last check, True if a new card was applied"""
+        signature = self.stat()
+        if signature is None or signature == self.signature:
+            return False
+        # Remembered even when the new version is broken, saving a fixed version changes it again
+        self.signature = signature
+        try:
+            card, template = load_card(self.path)
+        except CardError as exn:
+            log.warning(f"Keeping the current character card: {exn}")
+            return False
+        self.apply(card, template)
+        log.info(f"Reloaded the character card from {self.path}")
+        return True
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.check()
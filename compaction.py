@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import time
+
+from slixmpp import JID
+
+import metrics
+from backend_pool import NoHealthyBackend
+from images import prune_images
+
+log = logging.getLogger(__name__)
+
+# Fractions of the card's max_context_length: compaction starts above the threshold and folds turns until the
+# conversation is back under the target
+DEFAULT_COMPACT_THRESHOLD = 0.75
+DEFAULT_COMPACT_TARGET = 0.5
+DEFAULT_COMPACT_IDLE = 30.0
+# The most recent turns are always kept verbatim
+DEFAULT_KEEP_TURNS = 4
+# Rough average for English text, close enough to decide when to compact without a tokenizer round trip
+CHARS_PER_TOKEN = 4
+SUMMARY_TOKENS = 256
+SUMMARIZE_INSTRUCTION = ("Summarize the conversation below in a few sentences for your own reference. Keep names, "
+                         "facts, decisions and open questions, leave out pleasantries. Reply with the summary only.")
+SUMMARY_TURN = "(Summary of our conversation so far: {summary})"
+SUMMARY_ACKNOWLEDGEMENT = "Understood."
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class Turn:
+    __slots__ = ("length", "prompt", "response")
+
+    def __init__(self, length: int, prompt: str | None, response: str):
+        # length of the rendered turn in the session prompt, a prompt of None marks a summary of older turns
+        self.length = length
+        self.prompt = prompt
+        self.response = response
+
+
+class History:
+    """
+    Where the turns of one session are in its prompt, the turns end where the session prompt ends. Sessions that keep
+    chat messages as well hold a user and an assistant message per turn from message_start on.
+    """
+
+    def __init__(self, session: dict, start: int):
+        self.session = session
+        self.start = start
+        self.message_start = len(session.get('messages', ())) - 2
+        self.turns = []
+        self.active = time.monotonic()
+        self.task = None
+
+    @property
+    def end(self) -> int:
+        return self.start + sum(turn.length for turn in self.turns)
+
+
+class Compactor:
+    """
+    Folds the oldest turns of long conversations into a summary, so the prompt, and with it the prefill of every
+    turn, stays bounded without forgetting what was said early on. Once a session grows past threshold of its
+    context, a background task waits until the user has been idle for idle seconds and their backend has nothing in
+    flight, has the backend summarize the oldest turns and splices the summary in their place. Only sessions whose
+    prompt still ends where the last recorded turn ended are touched, anything in flight or edited meanwhile is left
+    for a later round.
+    """
+
+    def __init__(self, bot, threshold: float = DEFAULT_COMPACT_THRESHOLD, target: float = DEFAULT_COMPACT_TARGET,
+                 idle: float = DEFAULT_COMPACT_IDLE, keep_turns: int = DEFAULT_KEEP_TURNS):
+        self.bot = bot
+        self.threshold = threshold
+        self.target = target
+        self.idle = idle
+        self.keep_turns = keep_turns
+        # bare JID -> History
+        self.histories = {}
+
+    def reset(self, jid: str) -> None:
+        history = self.histories.pop(jid, None)
+        if history is not None and history.task is not None:
+            history.task.cancel()
+
+    def record(self, jid: str, session: dict, start: int, prompt: str, response: str) -> None:
+        """Notes a turn that was rendered into the session prompt from start to its end"""
+        history = self.histories.get(jid)
+        if history is None or history.session is not session or history.end != start:
+            # New session, or its prompt was changed behind our back, e.g. by a reloaded card
+            self.reset(jid)
+            history = self.histories[jid] = History(session, start)
+        history.turns.append(Turn(len(session['prompt']) - start, prompt, response))
+        history.active = time.monotonic()
+        if history.task is None and self.prompt_tokens(history) > self.threshold * self.budget(session):
+            history.task = asyncio.ensure_future(self.run(jid, history))
+
+    @staticmethod
+    def budget(session: dict) -> int:
+        return session.get('max_context_length', 2048)
+
+    @staticmethod
+    def prompt_tokens(history: History) -> int:
+        # The card prompt takes up context as well, it just can not be folded
+        return estimate_tokens(history.session['prompt'])
+
+    def is_current(self, jid: str, history: History) -> bool:
+        session = history.session
+        return (self.histories.get(jid) is history and self.bot.user_sessions.get(jid) is session
+                and len(session['prompt']) == history.end
+                and ('messages' not in session
+                     or len(session['messages']) == history.message_start + 2 * len(history.turns)))
+
+    async def run(self, jid: str, history: History) -> None:
+        try:
+            while True:
+                await asyncio.sleep(self.idle)
+                if self.histories.get(jid) is not history:
+                    return None
+                if time.monotonic() - history.active < self.idle or not self.is_current(jid, history):
+                    continue
+                try:
+                    if self.bot.backends.pick(jid).outstanding > 0:
+                        continue
+                except NoHealthyBackend:
+                    continue
+                with metrics.span("compaction"):
+                    await self.compact(jid, history)
+                return None
+        except Exception:
+            log.exception(f"Compacting the conversation of {jid} failed")
+        finally:
+            history.task = None
+
+    def oldest(self, history: History) -> int:
+        """How many of the oldest turns to fold so the rest fits in target"""
+        excess = self.prompt_tokens(history) - self.target * self.budget(history.session)
+        count = 0
+        for turn in history.turns[:max(0, len(history.turns) - self.keep_turns)]:
+            if excess <= 0:
+                break
+            excess -= turn.length // CHARS_PER_TOKEN
+            count += 1
+        return count
+
+    async def compact(self, jid: str, history: History) -> None:
+        count = self.oldest(history)
+        # Folding just an earlier summary into itself gains nothing
+        if count == 0 or (count == 1 and history.turns[0].prompt is None):
+            return None
+        folded = history.turns[:count]
+        # The session's own template and card prompt, the persona may have been given a new card since it started
+        template = self.bot.template_for(jid)
+        transcript = "\n".join(f"Earlier summary: {turn.response}" if turn.prompt is None else
+                               f"User: {turn.prompt}\nAssistant: {turn.response}" for turn in folded)
+        instruction = f"{SUMMARIZE_INSTRUCTION}\n\n{transcript}"
+        request = dict(history.session)
+        request.pop('image_data', None)
+        request['prompt'] = history.session['prompt'][:history.start] + template.user_turn(instruction)
+        if 'messages' in request:
+            request['messages'] = (history.session['messages'][:history.message_start]
+                                   + [{'role': 'user', 'content': instruction}])
+        request['max_length'] = request['n_predict'] = min(request.get('max_length', SUMMARY_TOKENS), SUMMARY_TOKENS)
+        summary = template.clean(await self.bot.api_session(JID(jid), session=request)).strip()
+        if not summary:
+            return None
+        # The user may have written, reset or been handed a new card while the summary was generated
+        if not self.is_current(jid, history):
+            log.debug(f"Dropping the summary for {jid}, the conversation changed meanwhile")
+            return None
+        rendered = (template.user_turn(SUMMARY_TURN.format(summary=summary))
+                    + template.assistant_turn(SUMMARY_ACKNOWLEDGEMENT))
+        start = history.start
+        end = start + sum(turn.length for turn in folded)
+        session = history.session
+        session['prompt'] = session['prompt'][:start] + rendered + session['prompt'][end:]
+        if 'messages' in session:
+            session['messages'][history.message_start:history.message_start + 2 * count] = [
+                {'role': 'user', 'content': SUMMARY_TURN.format(summary=summary)},
+                {'role': 'assistant', 'content': SUMMARY_ACKNOWLEDGEMENT}]
+        history.turns[:count] = [Turn(len(rendered), None, summary)]
+        # Images of the folded turns would otherwise still be sent with every request
+        prune_images(session)
+        log.info(f"Compacted {count} turns of {jid} into a summary, {end - start} characters down to {len(rendered)}")
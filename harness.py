@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import logging
+import sys
+import time
+
+from slixmpp import JID
+
+log = logging.getLogger(__name__)
+
+DEFAULT_REPLAY_JIDS = 8
+SYNTHETIC_DOMAIN = "dryrun.example.com"
+
+
+def parse_prompt(line: str):
+    """
+    A replay line is either plain text or a JSON object with a "prompt" (or "body") and optionally the "jid" it
+    belongs to. Returns (jid, prompt), jid is None when the harness should pick one.
+    """
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        item = json.loads(line)
+    except json.JSONDecodeError:
+        return None, line
+    if isinstance(item, str):
+        return None, item
+    prompt = item.get("prompt", item.get("body"))
+    if prompt is None:
+        return None
+    return item.get("jid"), prompt
+
+
+def load_prompts(path: str) -> list[tuple]:
+    """Reads replay prompts from a JSONL file, or from stdin when path is -"""
+    file = sys.stdin if path == "-" else open(path, "r")
+    try:
+        return [prompt for prompt in map(parse_prompt, file) if prompt is not None]
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+
+def percentile(values: list[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def assign_jids(prompts: list[tuple], jids: int) -> dict:
+    """Groups prompts into conversations, prompts without a JID are dealt round robin to synthetic ones"""
+    conversations = {}
+    for index, (jid, prompt) in enumerate(prompts):
+        if jid is None:
+            jid = f"user{index % jids}@{SYNTHETIC_DOMAIN}"
+        conversations.setdefault(JID(jid).bare, []).append(prompt)
+    return conversations
+
+
+async def converse(bot, jid: str, prompts: list[str], results: list[dict]) -> None:
+    """One synthetic user, their prompts are sent one after the other like a real conversation"""
+    mfrom = JID(jid)
+    await bot.start_session(mfrom.bare)
+    for prompt in prompts:
+        start = time.perf_counter()
+        error = None
+        response = ""
+        try:
+            response = await bot.generate(mfrom, "chat", prompt)
+        except Exception as exn:
+            error = repr(exn)
+        results.append({"jid": mfrom.bare, "latency": time.perf_counter() - start, "chars": len(response or ""),
+                        "error": error})
+
+
+async def replay(bot, prompts: list[tuple], jids: int = DEFAULT_REPLAY_JIDS) -> dict:
+    """Drives every conversation through the bot concurrently and returns the per request results and a summary"""
+    conversations = assign_jids(prompts, jids)
+    results = []
+    start = time.perf_counter()
+    await asyncio.gather(*[converse(bot, jid, conversation, results) for jid, conversation in conversations.items()])
+    elapsed = time.perf_counter() - start
+
+    latencies = [result["latency"] for result in results if result["error"] is None]
+    summary = {
+        "requests": len(results),
+        "errors": len(results) - len(latencies),
+        "conversations": len(conversations),
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p99": percentile(latencies, 99),
+        "latency_max": max(latencies, default=0.0),
+    }
+    return {"summary": summary, "results": results}
+
+
+def report(summary: dict) -> None:
+    log.info(f"{summary['requests']} requests over {summary['conversations']} conversations in "
+             f"{summary['elapsed']:.2f}s, {summary['errors']} errors")
+    log.info(f"throughput {summary['throughput']:.2f} req/s, latency p50 {summary['latency_p50'] * 1000:.1f}ms "
+             f"p99 {summary['latency_p99'] * 1000:.1f}ms max {summary['latency_max'] * 1000:.1f}ms")
+
+
+async def run_replay(bot, path: str, jids: int = DEFAULT_REPLAY_JIDS) -> dict:
+    """Entry point for --replay"""
+    prompts = load_prompts(path)
+    try:
+        outcome = await replay(bot, prompts, jids)
+    finally:
+        if bot.http_session is not None:
+            await bot.http_session.close()
+    report(outcome["summary"])
+    for result in outcome["results"]:
+        if result["error"] is not None:
+            log.error(f"{result['jid']}: {result['error']}")
+    return outcome
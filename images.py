@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import base64
+import hashlib
+import logging
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from aiohttp import ClientError, ClientSession
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+# Longest side sent to the backend, LLaVA style projectors work on 336 pixel tiles
+DEFAULT_IMAGE_SIZE = 672
+DEFAULT_MAX_DOWNLOAD = 20 * 1024 * 1024
+DEFAULT_IMAGE_CACHE = 64
+DEFAULT_IMAGE_WORKERS = 2
+JPEG_QUALITY = 90
+# Backend modes that can be shown images, kobold.cpp would see the [img-ID] placeholder as text
+IMAGE_MODES = ("llama.cpp", "openai")
+# XEP-0454 media sharing links, the fragment is the 12 byte IV followed by the 32 byte key in hex
+AESGCM_URL_RE = re.compile(r'^aesgcm://(?P<location>\S+?)#(?P<fragment>[0-9a-fA-F]{88})$')
+
+
+class ImageError(Exception):
+    pass
+
+
+def is_attachment(body: str) -> bool:
+    return AESGCM_URL_RE.match(body.strip()) is not None
+
+
+def prune_images(session: dict) -> None:
+    """Drops the images a session prompt no longer shows, after a turn was rolled back or summarized away"""
+    images = [image for image in session.get('image_data', ()) if f"[img-{image['id']}]" in session['prompt']]
+    if images:
+        session['image_data'] = images
+    else:
+        session.pop('image_data', None)
+
+
+def decrypt(payload: bytes, fragment: str) -> bytes:
+    """AES-GCM as in XEP-0454, the tag is the last 16 bytes of the file"""
+    iv, key = bytes.fromhex(fragment[:24]), bytes.fromhex(fragment[24:])
+    try:
+        return AESGCM(key).decrypt(iv, payload, None)
+    except InvalidTag as exn:
+        raise ImageError("Attachment does not decrypt with the key of its link") from exn
+
+
+def prepare(data: bytes, size: int) -> str:
+    """Decodes an image, fits it in size x size and returns it as a base64 JPEG"""
+    try:
+        image = Image.open(BytesIO(data))
+        # JPEG can decode straight at a fraction of its resolution, much cheaper than decoding and then shrinking
+        image.draft("RGB", (size, size))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGB")
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as exn:
+        raise ImageError(f"Attachment is not an image: {exn}") from exn
+    image.thumbnail((size, size), Image.Resampling.LANCZOS)
+    output = BytesIO()
+    image.save(output, format="JPEG", quality=JPEG_QUALITY)
+    return base64.b64encode(output.getvalue()).decode("ascii")
+
+
+class ImageFetcher:
+    """
+    Downloads, decrypts and downscales images that users send as encrypted attachments. Decoding and resizing run in
+    a thread pool off the event loop, prepared images are kept by the hash of their content so an image that is sent
+    again is not processed again.
+    """
+
+    def __init__(self, get_http_session, size: int = DEFAULT_IMAGE_SIZE, capacity: int = DEFAULT_IMAGE_CACHE,
+                 max_download: int = DEFAULT_MAX_DOWNLOAD, workers: int = DEFAULT_IMAGE_WORKERS):
+        self.get_http_session = get_http_session
+        self.size = size
+        self.capacity = capacity
+        self.max_download = max_download
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="images")
+        # content hash -> base64 JPEG, least recently used first
+        self.prepared = OrderedDict()
+
+    async def download(self, url: str) -> bytes:
+        http_session: ClientSession = self.get_http_session()
+        try:
+            async with http_session.get(url) as response:
+                response.raise_for_status()
+                if (response.content_length or 0) > self.max_download:
+                    raise ImageError(f"Attachment of {response.content_length} bytes is too large")
+                payload = bytearray()
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    payload += chunk
+                    if len(payload) > self.max_download:
+                        raise ImageError(f"Attachment is larger than {self.max_download} bytes")
+                return bytes(payload)
+        except (ClientError, asyncio.TimeoutError) as exn:
+            raise ImageError(f"Could not download attachment: {exn!r}") from exn
+
+    async def fetch(self, link: str) -> tuple[str, str]:
+        """Returns the content hash and base64 JPEG of the image behind an aesgcm:// link, raises ImageError"""
+        match = AESGCM_URL_RE.match(link.strip())
+        if match is None:
+            raise ImageError("Not an encrypted attachment link")
+        loop = asyncio.get_running_loop()
+        with metrics.span("image_download"):
+            payload = await self.download(f"https://{match.group('location')}")
+        data = await loop.run_in_executor(self.executor, decrypt, payload, match.group('fragment'))
+        digest = hashlib.sha256(data).hexdigest()
+        image = self.prepared.get(digest)
+        if image is None:
+            with metrics.span("image_prepare"):
+                image = await loop.run_in_executor(self.executor, prepare, data, self.size)
+            self.prepared[digest] = image
+            while len(self.prepared) > self.capacity:
+                self.prepared.popitem(last=False)
+        self.prepared.move_to_end(digest)
+        return digest, image
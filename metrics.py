@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import logging
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+DEFAULT_METRICS_HOST = "127.0.0.1"
+DEFAULT_METRICS_PORT = 9464
+# Upper bounds in seconds, a decrypt takes milliseconds while a TTS reply can take a minute
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRIC_NAME = "xmppbot_stage_seconds"
+
+current_trace = ContextVar("current_trace", default=None)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "count", "sum")
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # One slot per bucket plus one for everything above the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+
+class Trace:
+    """The stages one message went through, kept only while slow reply dumps are enabled"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.spans = []
+
+    def record(self, stage: str, start: float, seconds: float) -> None:
+        self.spans.append((stage, start - self.start, seconds))
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def dump(self) -> str:
+        return ", ".join(f"{stage} @{offset * 1000:.0f}ms {seconds * 1000:.1f}ms"
+                         for stage, offset, seconds in sorted(self.spans, key=lambda span: span[1]))
+
+
+class Span:
+    __slots__ = ("metrics", "stage", "start")
+
+    def __init__(self, metrics: "Metrics", stage: str):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start, self.start)
+        return False
+
+
+class Metrics:
+    """
+    One latency histogram per stage of handling a message. Stages are timed with `span`, and when slow_trace is set
+    every message handled inside `begin_trace`/`end_trace` that took longer than slow_trace seconds is logged with
+    the breakdown of its stages.
+    """
+
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS, slow_trace: float | None = None):
+        self.buckets = buckets
+        self.slow_trace = slow_trace
+        self.histograms = {}
+
+    def observe(self, stage: str, seconds: float, start: float | None = None) -> None:
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram(self.buckets)
+        histogram.observe(seconds)
+        trace = current_trace.get()
+        if trace is not None:
+            trace.record(stage, time.perf_counter() - seconds if start is None else start, seconds)
+
+    def span(self, stage: str) -> Span:
+        return Span(self, stage)
+
+    def begin_trace(self, name: str):
+        """Returns a token for end_trace, spans in this task and the tasks it starts are added to the trace"""
+        if self.slow_trace is None:
+            return None
+        return current_trace.set(Trace(name))
+
+    def end_trace(self, token) -> None:
+        if token is None:
+            return None
+        trace = current_trace.get()
+        current_trace.reset(token)
+        if trace.elapsed >= self.slow_trace:
+            log.warning(f"Slow reply to {trace.name} took {trace.elapsed * 1000:.0f}ms: {trace.dump()}")
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        lines = [f"# HELP {METRIC_NAME} Time spent in each stage of handling a message",
+                 f"# TYPE {METRIC_NAME} histogram"]
+        for stage, histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{METRIC_NAME}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{METRIC_NAME}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'{METRIC_NAME}_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'{METRIC_NAME}_count{{stage="{stage}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves GET /metrics for Prometheus to scrape, keep it on localhost"""
+
+    def __init__(self, metrics: Metrics, host: str = DEFAULT_METRICS_HOST, port: int = DEFAULT_METRICS_PORT):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self.app = web.Application()
+        self.app.router.add_get("/metrics", self.handle_metrics)
+        self._runner = None
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        log.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(body=self.metrics.render().encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+# Shared by every module, like the logging module's root logger
+registry = Metrics()
+
+
+def span(stage: str) -> Span:
+    return registry.span(stage)
+
+
+def observe(stage: str, seconds: float) -> None:
+    registry.observe(stage, seconds)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import logging
+import subprocess
+import threading
+from functools import lru_cache
+
+import numpy as np
+from scipy.signal import sosfilt
+
+from sound import NoiseGenerator
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE_RATE = 24000
+DEFAULT_BLOCK_SIZE = 4096
+# Same length as audio_processing/silence.wav, which used to be spliced between sentences
+DEFAULT_GAP = 0.3
+DEFAULT_CROSSFADE = 0.02
+DEFAULT_NOISE_LEVEL = 0.02
+DEFAULT_DUCK_GAIN = 0.3
+DEFAULT_DUCK_ATTACK = 0.05
+DEFAULT_DUCK_RELEASE = 0.25
+# Seconds of noise generated once per colour and level and looped for as long as a reply lasts
+DEFAULT_NOISE_LOOP = 8
+NOISE_COLOURS = ("white", "pink", "brown", "blue", "violet")
+# Frames quieter than this relative to the loudest frame of a sentence count as silence at its edges
+DEFAULT_TRIM_THRESHOLD = -40.0
+DEFAULT_TRIM_FRAME = 0.01
+# Kept either side of the speech so soft onsets and trailing consonants are not clipped
+DEFAULT_TRIM_PAD = 0.04
+NORMALIZE_MODES = ("loudness", "peak")
+DEFAULT_NORMALIZE = "loudness"
+# Integrated loudness in LUFS, the usual target for spoken word, and the peak ceiling in dBFS
+DEFAULT_TARGET_LOUDNESS = -16.0
+DEFAULT_TARGET_PEAK = -1.0
+
+
+@lru_cache(maxsize=8)
+def noise_loop(colour: str, level: float, block_size: int, sample_rate: int, seconds: float = DEFAULT_NOISE_LOOP,
+               seed: int = 0) -> np.ndarray:
+    """
+    A seamless loop of noise as a read-only (blocks, block_size) float32 array. The frames are overlap-added like
+    NoiseGenerator.stream but circularly, so the last block runs into the first without a seam.
+    """
+    generator = NoiseGenerator(seed=seed)
+    colour_function = getattr(generator, colour)()
+    dt = 1 / sample_rate
+    blocks = max(2, int(np.ceil(seconds * sample_rate / block_size)))
+    frame_size = 2 * block_size
+    window = np.sin(np.pi * (np.arange(frame_size) + 0.5) / frame_size).astype(np.float32)
+    window *= np.float32(level / generator.expected_rms(dt, frame_size, colour_function))
+
+    frames = np.stack([generator.generate(dt, frame_size, colour_function) for _ in range(blocks)]) * window
+    loop = frames[:, :block_size] + np.roll(frames[:, block_size:], 1, axis=0)
+    loop.flags.writeable = False
+    return loop
+
+
+def trim_silence(waveform: np.ndarray, sample_rate: int, threshold: float = DEFAULT_TRIM_THRESHOLD,
+                 frame: float = DEFAULT_TRIM_FRAME, pad: float = DEFAULT_TRIM_PAD) -> np.ndarray:
+    """Returns a view of waveform without the leading and trailing frames below threshold dB of its loudest frame"""
+    frame_length = max(1, round(frame * sample_rate))
+    frames = len(waveform) // frame_length
+    if frames == 0:
+        return waveform
+    energy = np.square(waveform[:frames * frame_length]).reshape(frames, frame_length).mean(axis=1)
+    loud = np.flatnonzero(energy > energy.max() * 10 ** (threshold / 10))
+    if len(loud) == 0:
+        return waveform[:0]
+    padding = round(pad * sample_rate)
+    start = max(0, loud[0] * frame_length - padding)
+    end = min(len(waveform), (loud[-1] + 1) * frame_length + padding)
+    return waveform[start:end]
+
+
+def biquad(b: list[float], a: list[float]) -> list[float]:
+    return [b[0] / a[0], b[1] / a[0], b[2] / a[0], 1.0, a[1] / a[0], a[2] / a[0]]
+
+
+@lru_cache(maxsize=4)
+def k_weighting(sample_rate: int) -> np.ndarray:
+    """
+    The ITU-R BS.1770 K-weighting pre-filter, a high shelf for the acoustic effect of the head followed by a high
+    pass, designed for any sample rate as second order sections.
+    """
+    w0 = 2 * np.pi * 1500.0 / sample_rate
+    a = 10 ** (4.0 / 40)
+    alpha = np.sin(w0) / (2 * (1 / np.sqrt(2)))
+    cos = np.cos(w0)
+    shelf = biquad([a * ((a + 1) + (a - 1) * cos + 2 * np.sqrt(a) * alpha),
+                    -2 * a * ((a - 1) + (a + 1) * cos),
+                    a * ((a + 1) + (a - 1) * cos - 2 * np.sqrt(a) * alpha)],
+                   [(a + 1) - (a - 1) * cos + 2 * np.sqrt(a) * alpha,
+                    2 * ((a - 1) - (a + 1) * cos),
+                    (a + 1) - (a - 1) * cos - 2 * np.sqrt(a) * alpha])
+    w0 = 2 * np.pi * 38.0 / sample_rate
+    alpha = np.sin(w0) / (2 * 0.5)
+    cos = np.cos(w0)
+    high_pass = biquad([(1 + cos) / 2, -(1 + cos), (1 + cos) / 2], [1 + alpha, -2 * cos, 1 - alpha])
+    return np.asarray([shelf, high_pass], dtype=np.float32)
+
+
+def loudness(sentences: list[np.ndarray], sample_rate: int) -> float:
+    """
+    Gated integrated loudness in LUFS after BS.1770: the mean square of overlapping 400 ms blocks of the K-weighted
+    signal, ignoring blocks below -70 LUFS and then blocks 10 LU below the loudness of the rest. Blocks are taken
+    per sentence, the gaps between sentences would be gated out anyway.
+    """
+    sos = k_weighting(sample_rate)
+    block = round(0.4 * sample_rate)
+    step = round(0.1 * sample_rate)
+    powers = []
+    for sentence in sentences:
+        if len(sentence) == 0:
+            continue
+        squared = np.cumsum(np.square(sosfilt(sos, sentence)), dtype=np.float64)
+        squared = np.concatenate(([0.0], squared))
+        length = min(block, len(sentence))
+        starts = np.arange(0, len(sentence) - length + 1, step)
+        powers.append((squared[starts + length] - squared[starts]) / length)
+    if not powers:
+        return -np.inf
+    powers = np.concatenate(powers)
+    with np.errstate(divide="ignore"):
+        powers = powers[-0.691 + 10 * np.log10(powers) > -70]
+        if len(powers) == 0:
+            return -np.inf
+        relative_gate = -0.691 + 10 * np.log10(powers.mean()) - 10
+        powers = powers[-0.691 + 10 * np.log10(powers) > relative_gate]
+        return float(-0.691 + 10 * np.log10(powers.mean()))
+
+
+class Mixer:
+    """
+    Assembles TTS sentences into one reply in memory. Silence at the edges of each sentence is trimmed, sentences are
+    laid out with a gap between them and short equal-power fades at their edges, the voice is brought to a target
+    loudness or peak and an optional noise bed runs underneath and ducks while someone is speaking. Everything is
+    rendered block by block into float32 buffers of block_size samples.
+    """
+
+    def __init__(self, sample_rate: int = DEFAULT_SAMPLE_RATE, block_size: int = DEFAULT_BLOCK_SIZE,
+                 gap: float = DEFAULT_GAP, crossfade: float = DEFAULT_CROSSFADE, noise_colour: str | None = None,
+                 noise_level: float = DEFAULT_NOISE_LEVEL, duck_gain: float = DEFAULT_DUCK_GAIN,
+                 duck_attack: float = DEFAULT_DUCK_ATTACK, duck_release: float = DEFAULT_DUCK_RELEASE,
+                 trim: bool = True, trim_threshold: float = DEFAULT_TRIM_THRESHOLD,
+                 normalize: str | None = DEFAULT_NORMALIZE, target_loudness: float = DEFAULT_TARGET_LOUDNESS,
+                 target_peak: float = DEFAULT_TARGET_PEAK):
+        if noise_colour is not None and noise_colour not in NOISE_COLOURS:
+            raise ValueError(f"Unknown noise colour {noise_colour}, expected one of {', '.join(NOISE_COLOURS)}")
+        if normalize is not None and normalize not in NORMALIZE_MODES:
+            raise ValueError(f"Unknown normalization {normalize}, expected one of {', '.join(NORMALIZE_MODES)}")
+        self.sample_rate = sample_rate
+        self.block_size = block_size
+        self.gap = round(gap * sample_rate)
+        self.crossfade = round(crossfade * sample_rate)
+        self.noise_colour = noise_colour
+        self.noise_level = noise_level
+        self.duck_gain = duck_gain
+        self.duck_attack = round(duck_attack * sample_rate)
+        self.duck_release = round(duck_release * sample_rate)
+        self.trim = trim
+        self.trim_threshold = trim_threshold
+        self.normalize = normalize
+        self.target_loudness = target_loudness
+        self.target_peak = target_peak
+        ramp = np.sin(0.5 * np.pi * (np.arange(self.crossfade) + 0.5) / max(1, self.crossfade)).astype(np.float32)
+        self.fade_in = ramp
+        self.fade_out = ramp[::-1].copy()
+
+    def layout(self, sentences: list[np.ndarray]) -> list[int]:
+        """Start sample of each sentence, neighbours overlap by the crossfade when the gap is shorter than it"""
+        starts = []
+        position = 0
+        for sentence in sentences:
+            starts.append(position)
+            position += max(1, len(sentence) + self.gap - self.crossfade)
+        return starts
+
+    def duck_envelope(self, starts: list[int], sentences: list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+        """Breakpoints of the noise bed gain, pauses shorter than attack plus release stay ducked"""
+        spans = []
+        for start, sentence in zip(starts, sentences):
+            end = start + len(sentence)
+            if spans and start - spans[-1][1] <= self.duck_attack + self.duck_release:
+                spans[-1][1] = max(spans[-1][1], end)
+            else:
+                spans.append([start, end])
+        points = []
+        for start, end in spans:
+            points += [(start - self.duck_attack, 1.0), (start, self.duck_gain), (end, self.duck_gain),
+                       (end + self.duck_release, 1.0)]
+        x, y = zip(*points)
+        return np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float32)
+
+    def gain(self, sentences: list[np.ndarray]) -> float:
+        """Voice gain that reaches the target loudness, or the target peak, without the peak going over target_peak"""
+        peak = max((float(np.max(np.abs(sentence))) for sentence in sentences if len(sentence)), default=0.0)
+        if self.normalize is None or peak == 0:
+            return 1.0
+        ceiling = 10 ** (self.target_peak / 20) / peak
+        if self.normalize == "peak":
+            return ceiling
+        level = loudness(sentences, self.sample_rate)
+        if not np.isfinite(level):
+            return 1.0
+        return min(10 ** ((self.target_loudness - level) / 20), ceiling)
+
+    def blocks(self, sentences: list[np.ndarray]):
+        """
+        Yields the mixed reply in float32 blocks. The edges of the sentences are faded in place, pass copies if the
+        originals are still needed.
+        """
+        sentences = [np.asarray(sentence, dtype=np.float32).reshape(-1) for sentence in sentences]
+        if self.trim:
+            sentences = [trim_silence(sentence, self.sample_rate, self.trim_threshold) for sentence in sentences]
+        sentences = [sentence for sentence in sentences if len(sentence)]
+        level = np.float32(self.gain(sentences))
+        for sentence in sentences:
+            fade = min(self.crossfade, len(sentence) // 2)
+            sentence[:fade] *= self.fade_in[:fade]
+            sentence[len(sentence) - fade:] *= self.fade_out[self.crossfade - fade:]
+        if not sentences:
+            return None
+
+        starts = self.layout(sentences)
+        length = starts[-1] + len(sentences[-1])
+        noise = None
+        if self.noise_colour is not None and self.noise_level > 0:
+            noise = noise_loop(self.noise_colour, self.noise_level, self.block_size, self.sample_rate)
+            duck_x, duck_y = self.duck_envelope(starts, sentences)
+
+        first = 0
+        for index, block_start in enumerate(range(0, length, self.block_size)):
+            block_end = min(length, block_start + self.block_size)
+            block = np.zeros(block_end - block_start, dtype=np.float32)
+            # Sentences are in order, skip the ones that ended before this block
+            while starts[first] + len(sentences[first]) <= block_start:
+                first += 1
+            for start, sentence in zip(starts[first:], sentences[first:]):
+                if start >= block_end:
+                    break
+                lower = max(start, block_start)
+                upper = min(start + len(sentence), block_end)
+                block[lower - block_start:upper - block_start] += sentence[lower - start:upper - start]
+            block *= level
+            if noise is not None:
+                gain = np.interp(np.arange(block_start, block_end), duck_x, duck_y).astype(np.float32)
+                block += noise[index % len(noise)][:len(block)] * gain
+            yield block
+
+    def pcm(self, sentences: list[np.ndarray]):
+        """Yields the mixed reply as 16 bit little endian PCM"""
+        for block in self.blocks(sentences):
+            np.clip(block, -1.0, 1.0, out=block)
+            yield (block * 32767).astype("<i2").tobytes()
+
+    def encode(self, sentences: list[np.ndarray], path: str | None = None, format: str = "mp3") -> bytes | None:
+        """
+        Mixes and encodes straight into the file at path, ffmpeg picks the format from its extension. Without a path
+        the encoded audio is returned instead, in the given format.
+        """
+        output = ["-f", format, "pipe:1"] if path is None else [path]
+        process = subprocess.Popen(["ffmpeg", "-y", "-loglevel", "error", "-f", "s16le", "-ar", str(self.sample_rate),
+                                    "-ac", "1", "-i", "pipe:0"] + output,
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE if path is None else None)
+        errors = []
+
+        def feed():
+            try:
+                for chunk in self.pcm(sentences):
+                    process.stdin.write(chunk)
+            except Exception as exn:
+                errors.append(exn)
+            finally:
+                process.stdin.close()
+
+        encoded = None
+        if path is None:
+            # ffmpeg stops reading once its output pipe is full, so the PCM goes in from another thread
+            feeder = threading.Thread(target=feed, name="mixer-feed")
+            feeder.start()
+            encoded = process.stdout.read()
+            feeder.join()
+        else:
+            feed()
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg exited with {process.returncode} while encoding {path or format}")
+        if errors:
+            raise errors[0]
+        return encoded
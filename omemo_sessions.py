@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import time
+
+from slixmpp import JID
+from slixmpp.exceptions import IqTimeout, IqError
+from slixmpp_omemo import EncryptionPrepareException, UndecidedException
+from omemo.exceptions import MissingBundleException
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_ATTEMPTS = 4
+DEFAULT_BACKOFF = 0.5
+# Undecided devices trusted for a single message before giving up, a recipient has one per client they use
+DEFAULT_MAX_TRUSTS = 32
+# Devices that had no bundle are retried after this long in case they have published one since
+DEFAULT_PROBLEM_TTL = 3600
+# The device list of a recipient is queried again at most this often, or when they publish a new one
+DEFAULT_DEVICE_TTL = 600
+
+
+class OmemoSessions:
+    """
+    OMEMO state the bot keeps per recipient across replies.
+
+    The devices that could not be encrypted for are remembered and passed as `expect_problems` on later replies, so a
+    contact with a broken device costs a bundle IQ round-trip once rather than on every reply, and the user is told
+    about it once. The active device list of each recipient is cached and refreshed in the background after a reply,
+    once device_ttl has passed or they published a new list, when it changes the remembered problems for devices that
+    went away are dropped.
+    """
+
+    def __init__(self, xmpp, max_attempts: int = DEFAULT_MAX_ATTEMPTS, backoff: float = DEFAULT_BACKOFF,
+                 problem_ttl: float = DEFAULT_PROBLEM_TTL, device_ttl: float = DEFAULT_DEVICE_TTL,
+                 max_trusts: int = DEFAULT_MAX_TRUSTS):
+        self.xmpp = xmpp
+        self.max_attempts = max_attempts
+        self.max_trusts = max_trusts
+        self.backoff = backoff
+        self.problem_ttl = problem_ttl
+        self.device_ttl = device_ttl
+        # bare JID -> {device id: time the problem was seen}
+        self.problems = {}
+        # bare JID -> frozenset of active device ids at the last refresh
+        self.devices = {}
+        # bare JID -> when its device list was last queried
+        self.refreshed = {}
+        xmpp.add_event_handler('omemo_device_list_publish', self.device_list_published)
+
+    def device_list_published(self, msg) -> None:
+        # The plugin stores the new list itself, the next reply compares it with ours
+        self.refreshed.pop(msg['from'].bare, None)
+
+    def expect_problems(self, recipients: list[JID]) -> dict:
+        now = time.monotonic()
+        expect_problems = {}
+        for jid in recipients:
+            problems = self.problems.get(jid.bare, {})
+            for device, seen in list(problems.items()):
+                if now - seen > self.problem_ttl:
+                    del problems[device]
+            if problems:
+                expect_problems[JID(jid.bare)] = list(problems)
+        return expect_problems
+
+    async def refresh_devices(self, jid: JID) -> None:
+        devices = frozenset(await self.xmpp['xep_0384'].get_active_devices(JID(jid.bare)))
+        cached = self.devices.get(jid.bare)
+        if cached is not None and cached != devices:
+            log.debug(f'OMEMO device list of {jid.bare} changed from {sorted(cached)} to {sorted(devices)}')
+            problems = self.problems.get(jid.bare, {})
+            for device in set(problems) - devices:
+                del problems[device]
+        self.devices[jid.bare] = devices
+
+    def schedule_refresh(self, jid: JID) -> None:
+        now = time.monotonic()
+        if now - self.refreshed.get(jid.bare, -self.device_ttl) < self.device_ttl:
+            return None
+        self.refreshed[jid.bare] = now
+        asyncio.ensure_future(self._refresh(jid))
+
+    async def _refresh(self, jid: JID) -> None:
+        try:
+            await self.refresh_devices(jid)
+        except Exception:
+            # Nobody awaits the refresh, it is tried again after the next reply
+            self.refreshed.pop(jid.bare, None)
+            log.exception(f'Could not refresh the OMEMO device list of {jid.bare}')
+
+    async def encrypt(self, body: str, recipients: list[JID], notify=None):
+        """
+        Returns the `<encrypted/>` element for body, resolving trust and bundle problems on the way.
+        notify is an optional coroutine function told about each device that gets skipped for the first time.
+        """
+        start = time.perf_counter()
+        attempt = 0
+        trusts = 0
+        while True:
+            try:
+                encrypted = await self.xmpp['xep_0384'].encrypt_message(body, recipients,
+                                                                        self.expect_problems(recipients))
+                for jid in recipients:
+                    self.schedule_refresh(jid)
+                seconds = time.perf_counter() - start
+                metrics.observe("encrypt", seconds)
+                log.debug(f'Encrypted for {[jid.bare for jid in recipients]} in {attempt + 1} attempt(s), '
+                          f'{seconds * 1000:.1f}ms')
+                return encrypted
+            except UndecidedException as exn:
+                # Automatically trust undecided recipients, trust is stored by the plugin so this happens once
+                trusts += 1
+                if trusts > self.max_trusts:
+                    log.error(f'Still undecided about device {exn.device} of {exn.bare_jid} after trusting '
+                              f'{self.max_trusts} devices, giving up')
+                    raise
+                await self.xmpp['xep_0384'].trust(exn.bare_jid, exn.device, exn.ik)
+            except EncryptionPrepareException as exn:
+                # We choose to ignore MissingBundleException. It seems to be somewhat accepted that it's better
+                # not to encrypt for a device if it has problems and encrypt for the rest, rather than error out.
+                new_problems = False
+                for error in exn.errors:
+                    if isinstance(error, MissingBundleException):
+                        problems = self.problems.setdefault(JID(error.bare_jid).bare, {})
+                        if error.device not in problems:
+                            new_problems = True
+                            if notify is not None:
+                                await notify(f'Could not find keys for device "{error.device}"'
+                                             f' of recipient "{error.bare_jid}". Skipping.')
+                        problems[error.device] = time.monotonic()
+                if not new_problems:
+                    # Same errors as last time, retrying will not help
+                    raise
+            except (IqError, IqTimeout):
+                attempt += 1
+                if attempt == self.max_attempts:
+                    raise
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+
+    async def decrypt(self, encrypted, mfrom: JID, allow_untrusted: bool = False):
+        with metrics.span("decrypt"):
+            return await self.xmpp['xep_0384'].decrypt_message(encrypted, mfrom, allow_untrusted)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import functools
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+DEFAULT_COALESCE_WINDOW = 0.5
+DEFAULT_SEPARATOR = "\n\n"
+# Sustained messages per second per recipient, and how many may go out back to back after a quiet period
+DEFAULT_RATE = 1.0
+DEFAULT_BURST = 5
+
+# Priority lanes, lower goes first
+PRIORITY_COMMAND = 0
+PRIORITY_REPLY = 1
+# Partial text of a generation that is still running, never merged, superseded by the next update or by the reply
+PRIORITY_PROGRESS = 2
+
+
+def is_attachment(body: str) -> bool:
+    """OMEMO media links (XEP-0454) only render as media when they are the whole body, so they are never merged"""
+    return body.startswith("aesgcm://") and not any(char.isspace() for char in body)
+
+
+class TokenBucket:
+    def __init__(self, rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def full(self) -> bool:
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.burst
+
+    async def take(self) -> None:
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class OutboundQueue:
+    """
+    Collects outgoing bodies per destination. Bodies that arrive within `window` seconds of each other in the same
+    priority lane are merged into a single message so a burst of replies costs one encryption pass and one stanza.
+    Each destination has its own token bucket, and whenever a message is about to go out the lowest priority lane
+    that has something waiting goes first, so command replies overtake long generations. Progress updates are kept
+    apart, only the latest one waits and a reply to the same destination drops it.
+
+    send is a coroutine function taking the destination key and the merged body.
+    """
+
+    def __init__(self, send, window: float = DEFAULT_COALESCE_WINDOW, separator: str = DEFAULT_SEPARATOR,
+                 rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST):
+        self.send = send
+        self.window = window
+        self.separator = separator
+        self.rate = rate
+        self.burst = burst
+        # key -> {priority: list of batches}, each batch is a list of bodies that will go out as one message
+        self.pending = {}
+        self.buckets = {}
+        self.senders = {}
+
+    def put(self, key, body: str, priority: int = PRIORITY_REPLY) -> None:
+        lanes = self.pending.setdefault(key, {})
+        if priority == PRIORITY_REPLY:
+            lanes.pop(PRIORITY_PROGRESS, None)
+        batches = lanes.setdefault(priority, [])
+        if priority == PRIORITY_PROGRESS:
+            batches[:] = [[body]]
+        elif is_attachment(body):
+            batches.append([body])
+            batches.append([])
+        elif batches:
+            batches[-1].append(body)
+        else:
+            batches.append([body])
+
+        sender = self.senders.get(key)
+        if sender is None or sender.done():
+            sender = self.senders[key] = asyncio.ensure_future(self._send_pending(key))
+            sender.add_done_callback(functools.partial(self._sender_done, key))
+
+    @staticmethod
+    def _sender_done(key, sender) -> None:
+        # Failed sends are logged as they happen, this catches anything else that ended a sender
+        if not sender.cancelled() and sender.exception() is not None:
+            log.error(f'Sending queued messages to {key} stopped', exc_info=sender.exception())
+
+    def _next_batch(self, key):
+        lanes = self.pending.get(key, {})
+        for priority in sorted(lanes):
+            batches = lanes[priority]
+            while batches:
+                batch = batches.pop(0)
+                if batch:
+                    return batch
+            del lanes[priority]
+        self.pending.pop(key, None)
+        return None
+
+    async def _send_pending(self, key) -> None:
+        bucket = self.buckets.setdefault(key, TokenBucket(self.rate, self.burst))
+        while key in self.pending:
+            await asyncio.sleep(self.window)
+            while True:
+                await bucket.take()
+                # Picked only once a token is available so anything that arrived meanwhile can still overtake
+                batch = self._next_batch(key)
+                if batch is None:
+                    # Nothing was sent, hand the token back
+                    bucket.tokens += 1
+                    break
+                try:
+                    await self.send(key, self.separator.join(batch))
+                except Exception:
+                    log.exception(f'Failed to send queued messages to {key}')
+        # Drained. A bucket that has filled up again is no different from the one a new sender would start with
+        if self.senders.get(key) is asyncio.current_task():
+            del self.senders[key]
+        for idle in [idle for idle, bucket in self.buckets.items() if idle not in self.senders and bucket.full()]:
+            del self.buckets[idle]
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import logging
+from pathlib import Path
+
+from prompt_templates import PromptTemplate
+
+log = logging.getLogger(__name__)
+
+
+class Persona:
+    """A character card the bot can speak as, with its compiled template and the state that goes with its prompt"""
+
+    def __init__(self, name: str, path: str, card: dict, template: PromptTemplate, prefix_cache=None):
+        self.name = name
+        self.path = path
+        self.card = card
+        self.template = template
+        self.prefix_cache = prefix_cache
+        self.watcher = None
+
+
+def parse_persona(value: str) -> tuple[str, str]:
+    """NAME=PATH, or just PATH which is then named after the file"""
+    name, separator, path = value.partition("=")
+    if not separator:
+        return Path(value).stem, value
+    return name, path
+
+
+class PersonaRegistry:
+    """The personas of one bot and which one each bare JID talks to, the first persona added is the default"""
+
+    def __init__(self):
+        self.personas = {}
+        # bare JID -> persona name, JIDs that never chose one talk to the default
+        self.selected = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.personas
+
+    def __iter__(self):
+        return iter(self.personas.values())
+
+    def names(self) -> list[str]:
+        return list(self.personas)
+
+    @property
+    def default(self) -> Persona:
+        return next(iter(self.personas.values()))
+
+    def add(self, persona: Persona) -> None:
+        if persona.name in self.personas:
+            raise ValueError(f"There is already a persona named {persona.name}")
+        self.personas[persona.name] = persona
+
+    def for_jid(self, jid: str) -> Persona:
+        name = self.selected.get(jid)
+        if name is None:
+            return self.default
+        return self.personas[name]
+
+    def select(self, jid: str, name: str) -> Persona:
+        persona = self.personas[name]
+        self.selected[jid] = name
+        return persona
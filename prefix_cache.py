@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+import logging
+import time
+from contextlib import contextmanager
+
+from aiohttp import ClientError, ClientSession
+
+from backend_pool import Backend
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SLOT_FILE_PREFIX = "upperdeck"
+
+
+class SlotAllocator:
+    """
+    Which bare JID owns which slot of each llama.cpp server, shared by the prefix caches of all personas. A JID keeps
+    its slot, and the KV state in it, until the slot is handed to another session as the least recently used one.
+    Slots with one of our requests in flight are neither handed over nor pinned.
+    """
+
+    def __init__(self):
+        # backend url -> bare JID owning each slot, None while it is free
+        self.owners = {}
+        # backend url -> slots with a pinned request in flight
+        self.busy = {}
+        # (backend url, bare JID) -> when the JID last used its slot
+        self.used = {}
+
+    def set_count(self, url: str, count: int) -> None:
+        owners = self.owners.get(url)
+        if owners is not None and len(owners) == count:
+            return None
+        # First count, or the server came back with a different number of slots and forgot their state anyway
+        for jid in owners or ():
+            self.used.pop((url, jid), None)
+        self.owners[url] = [None] * count
+
+    def slot_of(self, url: str, jid: str) -> int | None:
+        try:
+            return self.owners.get(url, []).index(jid)
+        except ValueError:
+            return None
+
+    def vacate(self, url: str) -> int | None:
+        """A free slot, or the least recently used idle one taken from its owner, None if every slot is busy"""
+        owners = self.owners.get(url, [])
+        busy = self.busy.get(url, set())
+        idle = [slot for slot in range(len(owners)) if slot not in busy]
+        if not idle:
+            return None
+        slot = min(idle, key=lambda index: -1.0 if owners[index] is None else self.used.get((url, owners[index]), 0.0))
+        if owners[slot] is not None:
+            log.debug(f"Slot {slot} of {url} is taken from {owners[slot]}, its state will be prefilled again")
+            self.used.pop((url, owners[slot]), None)
+            owners[slot] = None
+        return slot
+
+    def claim(self, url: str, jid: str) -> int | None:
+        """The slot of a session that starts over, the JID's own unless it is busy, otherwise a vacated one"""
+        slot = self.slot_of(url, jid)
+        if slot is None:
+            slot = self.vacate(url)
+            if slot is None:
+                return None
+            self.owners[url][slot] = jid
+        elif slot in self.busy.get(url, ()):
+            return None
+        self.used[(url, jid)] = time.monotonic()
+        return slot
+
+    @contextmanager
+    def hold(self, url: str, slot: int | None):
+        """Marks a slot busy while a request uses it"""
+        if slot is None:
+            yield None
+            return None
+        busy = self.busy.setdefault(url, set())
+        busy.add(slot)
+        try:
+            yield slot
+        finally:
+            busy.discard(slot)
+
+    @contextmanager
+    def pin(self, url: str, jid: str):
+        """The slot a request of jid may name, None if it owns none or it is busy"""
+        slot = self.slot_of(url, jid)
+        if slot is not None and slot in self.busy.get(url, ()):
+            slot = None
+        if slot is not None:
+            self.used[(url, jid)] = time.monotonic()
+        with self.hold(url, slot):
+            yield slot
+
+
+class PrefixCache:
+    """
+    Keeps the KV state of the character card's prompt on llama.cpp servers so new and reset sessions skip its prefill.
+
+    The first time a backend is used the card prompt is prefilled into an idle slot and saved with the slot save
+    endpoint (the server needs --slot-save-path). When a session starts over the saved state is restored into a slot
+    the SlotAllocator gives its JID, and its requests then name that slot and ask the server to reuse the cached
+    prompt. A JID that could not be given an idle slot skips the restore and lets the server choose.
+    """
+
+    def __init__(self, prompt: str, file_prefix: str = DEFAULT_SLOT_FILE_PREFIX, locks: dict | None = None,
+                 slots: SlotAllocator | None = None):
+        self.prompt = prompt
+        self.filename = f"{file_prefix}-{hashlib.sha256(prompt.encode('utf-8')).hexdigest()[:16]}.bin"
+        # backend url -> True once the prefix is saved there, False if the server can not save slots
+        self.saved = {}
+        # Shared by the caches of all personas, slots belong to JIDs whatever card they talk to
+        self.slots = SlotAllocator() if slots is None else slots
+        # backend url -> lock held while warming, shared by caches of different prompts
+        self._locks = {} if locks is None else locks
+
+    @contextmanager
+    def pin(self, backend: Backend, jid: str):
+        """Extra /completion fields that pin a request of jid to its slot, for as long as the request runs"""
+        if not self.saved.get(backend.url):
+            yield {}
+            return None
+        with self.slots.pin(backend.url, jid) as slot:
+            yield {"cache_prompt": True} if slot is None else {"id_slot": slot, "cache_prompt": True}
+
+    async def count_slots(self, http_session: ClientSession, backend: Backend) -> int:
+        # /slots is missing when the server runs with --no-slots, /props has the total on recent versions
+        async with http_session.get(f"{backend.url}/slots") as response:
+            if response.status == 200:
+                return max(1, len(await response.json()))
+        async with http_session.get(f"{backend.url}/props") as response:
+            if response.status == 200:
+                return max(1, (await response.json()).get("total_slots", 1))
+        return 1
+
+    async def slot_action(self, http_session: ClientSession, backend: Backend, slot: int, action: str) -> bool:
+        async with http_session.post(f"{backend.url}/slots/{slot}?action={action}",
+                                     json={"filename": self.filename}) as response:
+            if response.status != 200:
+                log.debug(f"Slot {action} on {backend.url} answered {response.status}: {await response.text()}")
+            return response.status == 200
+
+    async def warm(self, http_session: ClientSession, backend: Backend) -> bool:
+        """Prefills and saves the prefix on backend once, True if it can be restored from there"""
+        lock = self._locks.setdefault(backend.url, asyncio.Lock())
+        async with lock:
+            if backend.url in self.saved:
+                return self.saved[backend.url]
+            try:
+                self.slots.set_count(backend.url, await self.count_slots(http_session, backend))
+                # Left free afterwards, holding the prefix for whichever session comes next
+                slot = self.slots.vacate(backend.url)
+                if slot is None:
+                    log.debug(f"Every slot of {backend.url} is busy, warming the prompt prefix later")
+                    return False
+                with self.slots.hold(backend.url, slot):
+                    async with http_session.post(f"{backend.url}/completion",
+                                                 json={"prompt": self.prompt, "n_predict": 0, "cache_prompt": True,
+                                                       "id_slot": slot}) as response:
+                        response.raise_for_status()
+                    self.saved[backend.url] = await self.slot_action(http_session, backend, slot, "save")
+            except (ClientError, asyncio.TimeoutError) as exn:
+                log.warning(f"Could not warm the prompt prefix on {backend.url}: {exn!r}")
+                return False
+            if self.saved[backend.url]:
+                log.info(f"Saved the prompt prefix on {backend.url} as {self.filename}, "
+                         f"{len(self.slots.owners[backend.url])} slot(s)")
+            else:
+                log.warning(f"{backend.url} can not save slots, start it with --slot-save-path to keep the prompt "
+                            f"prefix across sessions")
+            return self.saved[backend.url]
+
+    async def restore(self, http_session: ClientSession, backend: Backend, jid: str) -> bool:
+        """Loads the saved prefix into the slot of jid, for a session that starts over"""
+        if backend.mode != "llama.cpp" or not await self.warm(http_session, backend):
+            return False
+        slot = self.slots.claim(backend.url, jid)
+        if slot is None:
+            log.debug(f"No idle slot on {backend.url} for {jid}, skipping the prefix restore")
+            return False
+        try:
+            with self.slots.hold(backend.url, slot):
+                return await self.slot_action(http_session, backend, slot, "restore")
+        except (ClientError, asyncio.TimeoutError) as exn:
+            log.warning(f"Could not restore the prompt prefix on {backend.url}: {exn!r}")
+            return False
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import re
+from string import Formatter
+
+# Built in prompt formats. A character card selects one of these with its "format" key, or ships its own under a
+# "template" key using the same fields, which makes adding a model format a config change rather than a code change.
+#
+#   user       appended to the session prompt for each user message, ends by cueing the assistant
+#   assistant  appended after the (cleaned) response, ends by cueing the next user message
+#   strip      strings removed from the response before it is stored or shown
+#   truncate   strings at which the response is cut off, everything after them is dropped
+#   message    per message template used by chat_to_prompt, either one string or a dict keyed by role
+#   generation appended by chat_to_prompt to cue the assistant to begin generation
+#
+# {prompt}, {response}, {role} and {content} are filled in per turn, any other field (e.g. {name}) is read from the
+# character card once when the template is compiled.
+DEFAULT_TEMPLATES = {
+    "alpaca": {
+        "user": "{prompt}\n### Response:\n",
+        "assistant": "{response}\n### Instruction:\n",
+    },
+    "mistral": {
+        "user": "[INST] {prompt}[/INST] ",
+        "assistant": " {response} </s>",
+        # clean badly formatted mistral close brackets
+        "truncate": ["\n["],
+    },
+    "chatml": {
+        "user": "{prompt}<|im_end|>\n<|im_start|>assistant\n",
+        "assistant": "{response}<|im_end|>\n<|im_start|>user\n",
+        # Clear incorrectly formatted chatml
+        "strip": ["<|im_end|>", "<|im_start|>", "\nuser"],
+        # Do not prepend the BOS as that seems to cause hallucinations...
+        "message": "<|im_start|>{role}\n{content}\n<|im_end|>\n",
+        "generation": "<|im_start|>assistant\n",
+    },
+    "pygmalion": {
+        "user": "{prompt}\n{name}:",
+        "assistant": "{response}\nYou: ",
+        "strip": ["\n{name}: ", "You:"],
+    },
+    "vicuna": {
+        "user": "{prompt}\nASSISTANT: ",
+        "assistant": "{response}\nUSER: ",
+    },
+    "llama3": {
+        "user": "{prompt}<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n",
+        "assistant": "{response}<|start_header_id|>user<|end_header_id|>\n\n",
+        "strip": ["!assistant", "?assistant", ".assistant"],
+        # Don't add BOS, llama.cpp server side is doing that
+        "message": "<|start_header_id|>{role}<|end_header_id|>\n\n{content}<|eot_id|>",
+        "generation": "<|start_header_id|>assistant<|end_header_id|>\n\n",
+    },
+    "phi-3": {
+        "user": "{prompt}<|end|>\n<|assistant|>\n",
+        "assistant": "{response}<|end|>\n<|user|>\n",
+        "strip": ["<|end|>"],
+        # Phi-3 might not support system prompt, but try anyway. Skip prepending BOS for now.
+        "message": "<|{role}|>\n{content}<|end|>\n",
+        "generation": "<|assistant|>\n",
+    },
+    "raw": {
+        "user": "{prompt}",
+        "assistant": "{response}",
+        # just concatenate all content fields if userland wants to pass raw string
+        "message": "{content}",
+        "generation": "",
+    },
+}
+
+# Names used by chat_to_prompt before the formats were unified
+TEMPLATE_ALIASES = {
+    "ChatML": "chatml",
+    "Llama-3": "llama3",
+    "Phi-3": "phi-3",
+    "Raw": "raw",
+}
+
+TURN_FIELDS = ("prompt", "response", "role", "content")
+CHAT_ROLES = ("system", "user", "assistant")
+# Control tokens of the built in formats, e.g. <|im_start|>, <|eot_id|> or [INST]
+SPECIAL_TOKEN_RE = re.compile(r"<\|[^|>]*\|>|\[/?INST\]|</?s>")
+
+
+def compile_format(text: str, static: dict) -> tuple:
+    """Splits a format string into literal and per turn field parts, filling in static fields ahead of time."""
+    parts = []
+    literal = ""
+    for prefix, field, _, _ in Formatter().parse(text):
+        literal += prefix
+        if field is None:
+            continue
+        if field in TURN_FIELDS:
+            parts.append((literal, field))
+            literal = ""
+        elif field in static:
+            literal += str(static[field])
+        else:
+            raise ValueError(f"Config Error: unknown field {{{field}}} in prompt template {text!r}")
+    return tuple(parts), literal
+
+
+def lenient_pattern(literal: str) -> str:
+    if not literal.strip():
+        return r"\s*"
+    return r"\s*" + re.escape(literal.strip()) + r"\s*"
+
+
+def render_format(compiled: tuple, values: dict) -> str:
+    parts, tail = compiled
+    return "".join([literal + values[field] for literal, field in parts]) + tail
+
+
+class PromptTemplate:
+    """
+    A prompt format compiled once per character card. Turns are rendered by appending to the session prompt so the
+    cost of a turn does not grow with the length of the conversation.
+    """
+
+    def __init__(self, name: str, spec: dict, static: dict = {}):
+        self.name = name
+        try:
+            self._user = compile_format(spec["user"], static)
+            self._assistant = compile_format(spec["assistant"], static)
+        except KeyError as e:
+            raise ValueError(f"Config Error: prompt template {name} is missing the {e} field")
+
+        message = spec.get("message")
+        if isinstance(message, str):
+            message = {role: message for role in CHAT_ROLES}
+        self._message = None
+        if message is not None:
+            self._message = {role: compile_format(text, static) for role, text in message.items()}
+        self.generation = spec.get("generation", "")
+
+        # Every cleanup rule goes into one alternation so the response is scanned once. Truncation matches run to
+        # the end of the string, longer strip strings go first so they win over their own prefixes.
+        strip = sorted({render_format(compile_format(s, static), {}) for s in spec.get("strip", [])},
+                       key=len, reverse=True)
+        truncate = [render_format(compile_format(s, static), {}) for s in spec.get("truncate", [])]
+        alternatives = ["(?:%s)[\\s\\S]*" % re.escape(t) for t in truncate] + [re.escape(s) for s in strip]
+        self._cleanup_re = re.compile("|".join(alternatives)) if alternatives else None
+
+    def user_turn(self, prompt: str) -> str:
+        """Text appended to the session prompt for a user message."""
+        return render_format(self._user, {"prompt": prompt})
+
+    def assistant_turn(self, response: str) -> str:
+        """Text appended to the session prompt after the assistant's cleaned response."""
+        return render_format(self._assistant, {"response": response})
+
+    def clean(self, response: str) -> str:
+        """Removes leftover stop sequences and badly formatted tags from a response in a single pass."""
+        if self._cleanup_re is None:
+            return response
+        return self._cleanup_re.sub("", response)
+
+    def parse_messages(self, text: str) -> list[dict]:
+        """
+        Reads complete chat messages back out of text rendered in this format, e.g. a character card's prompt.
+        Whitespace around the literal parts of the format is not compared, cards are often hand written.
+        """
+        if self._message is None:
+            raise NotImplementedError(f"{self.name} does not define a chat message template")
+        alternatives = []
+        for role, (parts, tail) in self._message.items():
+            pattern = ""
+            for literal, field in parts:
+                pattern += lenient_pattern(literal)
+                pattern += re.escape(role) if field == "role" else f"(?P<{role}>[\\s\\S]*?)"
+            alternatives.append(pattern + lenient_pattern(tail))
+        messages = []
+        for match in re.finditer("|".join(alternatives), text):
+            role = match.lastgroup
+            messages.append({"role": role, "content": match.group(role).strip()})
+        return messages
+
+    def render_message(self, role: str, content: str) -> str:
+        if self._message is None:
+            raise NotImplementedError(f"{self.name} does not define a chat message template")
+        if role not in self._message:
+            raise ValueError(f"{self.name} has no chat message template for the '{role}' role.")
+        return render_format(self._message[role], {"role": role, "content": content})
+
+
+def get_template(format: str, static: dict = {}) -> PromptTemplate:
+    """Compiles one of the built in formats by name."""
+    name = TEMPLATE_ALIASES.get(format, format)
+    if name not in DEFAULT_TEMPLATES:
+        raise NotImplementedError(f"{format} not in list of supported formats e.g. {', '.join(DEFAULT_TEMPLATES)}...")
+    return PromptTemplate(name, DEFAULT_TEMPLATES[name], static)
+
+
+def load_template(character_card: dict) -> PromptTemplate:
+    """
+    Compiles the prompt template for a character card. An inline "template" object in the card takes precedence,
+    fields it leaves out are taken from the built in template named by "format" if there is one.
+    """
+    name = character_card.get("format")
+    spec = {}
+    if name is not None:
+        spec.update(DEFAULT_TEMPLATES.get(TEMPLATE_ALIASES.get(name, name), {}))
+    spec.update(character_card.get("template", {}))
+    if not spec:
+        raise ValueError(f"Config Error: No matching prompt format found for {name!r}")
+    return PromptTemplate(name or "custom", spec, character_card)
+
+
+class RenderedChat:
+    """
+    An OpenAI style chat thread that keeps its rendered prompt alongside the messages, appending a message only
+    renders that message.
+    """
+
+    def __init__(self, template: PromptTemplate, chat_thread: list[dict] = ()):
+        self.template = template
+        self.messages = []
+        self.rendered = ""
+        for message in chat_thread:
+            self.append(message)
+
+    def append(self, message: dict) -> None:
+        # Error check to ensure 'role' and 'content' keys exist in each dict
+        try:
+            role = message["role"]
+            content = message["content"]
+        except KeyError as e:
+            raise ValueError(f"Each chat thread item must contain both 'role' and 'content' keys: {e}")
+        if role not in CHAT_ROLES:
+            raise ValueError("Chat thread only supports 'system', 'user', and 'assistant' roles.")
+        self.rendered += self.template.render_message(role, content)
+        self.messages.append(message)
+
+    def prompt(self) -> str:
+        """The rendered thread, ending by cueing the assistant to begin generation."""
+        return self.rendered + self.template.generation
+
+    def __len__(self):
+        return len(self.messages)
+
+
+def card_messages(character_card: dict, template: PromptTemplate) -> list[dict]:
+    """
+    The chat messages a character card starts a conversation with, for servers that apply their own template. A card
+    can list them under "messages" or give just a "system" prompt, otherwise they are read back out of its rendered
+    prompt, or for formats without a message template the prompt becomes the system message without control tokens.
+    """
+    if "messages" in character_card:
+        return [dict(message) for message in character_card["messages"]]
+    if "system" in character_card:
+        return [{"role": "system", "content": character_card["system"]}]
+    try:
+        messages = template.parse_messages(character_card["prompt"])
+    except NotImplementedError:
+        messages = []
+    if not messages:
+        messages = [{"role": "system", "content": SPECIAL_TOKEN_RE.sub("", character_card["prompt"]).strip()}]
+    return messages
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_CAPACITY = 256
+DEFAULT_CACHE_TTL = 24 * 3600
+# llama.cpp takes "seed", kobold.cpp takes "sampler_seed", -1 asks either for a random one
+SEED_KEYS = ("seed", "sampler_seed")
+
+
+def is_deterministic(session: dict) -> bool:
+    """Only greedy sampling or a fixed seed gives the same response to the same prompt every time"""
+    if session.get("temperature", 1) == 0:
+        return True
+    return any(session.get(key, -1) not in (-1, None) for key in SEED_KEYS)
+
+
+class ResponseCache:
+    """
+    Responses to deterministic requests, keyed on a hash of everything that is sent to the backend, i.e. the
+    rendered prompt and the sampler settings. Recently used entries are kept in memory, when a directory is given
+    every entry is also written there so the cache survives restarts and is shared between shard workers.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CACHE_CAPACITY, ttl: float = DEFAULT_CACHE_TTL,
+                 directory: str | None = None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.directory = directory
+        # key -> (time stored, response), least recently used first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(session: dict, mode: str) -> str:
+        payload = json.dumps(session, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(f"{mode}\n{payload}".encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        entry = self.entries.get(key)
+        if entry is None and self.directory is not None:
+            entry = self.read(key)
+        if entry is None or now - entry[0] > self.ttl:
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.remember(key, entry)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, response: str) -> None:
+        entry = (time.time(), response)
+        self.remember(key, entry)
+        if self.directory is not None:
+            self.write(key, entry)
+
+    def remember(self, key: str, entry: tuple) -> None:
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def read(self, key: str) -> tuple | None:
+        try:
+            with open(self.path(key), "r") as file:
+                item = json.load(file)
+            return item["time"], item["response"]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as exn:
+            log.warning(f"Ignoring unreadable response cache entry {key}: {exn!r}")
+            return None
+
+    def write(self, key: str, entry: tuple) -> None:
+        path = self.path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Written aside and renamed so a reader never sees half an entry
+            temporary = f"{path}.{os.getpid()}.tmp"
+            with open(temporary, "w") as file:
+                json.dump({"time": entry[0], "response": entry[1]}, file, ensure_ascii=False)
+            os.replace(temporary, path)
+        except OSError as exn:
+            log.warning(f"Could not write response cache entry {key}: {exn!r}")
+
+    def prune(self) -> int:
+        """Removes expired entries from the disk tier, returns how many were removed"""
+        if self.directory is None:
+            return 0
+        removed = 0
+        cutoff = time.time() - self.ttl
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+        return removed
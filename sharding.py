@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import hashlib
+import itertools
+import logging
+import multiprocessing
+from bisect import bisect
+from contextvars import ContextVar
+
+from slixmpp import JID
+
+log = logging.getLogger(__name__)
+
+# Points per shard on the hash ring, more points spread JIDs more evenly
+DEFAULT_REPLICAS = 64
+
+# Request id of the generation a worker task is running, so replies sent along the way can be routed back
+current_request = ContextVar("current_request", default=None)
+# Worker side, upload id -> future for the link the front process answers with
+uploads = {}
+upload_ids = itertools.count()
+
+
+class ShardError(Exception):
+    pass
+
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class ShardRing:
+    """Consistent hash of bare JIDs onto shards, changing the shard count only moves the JIDs it has to"""
+
+    def __init__(self, shards: int, replicas: int = DEFAULT_REPLICAS):
+        if shards < 1:
+            raise ValueError("At least one shard is required")
+        self.points = sorted((ring_hash(f"shard-{shard}-{replica}"), shard)
+                             for shard in range(shards) for replica in range(replicas))
+        self.hashes = [point for point, _ in self.points]
+
+    def shard_for(self, key: str) -> int:
+        return self.points[bisect(self.hashes, ring_hash(key)) % len(self.points)][1]
+
+
+class ShardPool:
+    """
+    Front process side of sharded mode. Every bare JID belongs to one worker process which keeps its session, renders
+    its prompts and calls the backend, the front process only decrypts, dispatches and encrypts the replies.
+
+    target(index, connection, *args) is run in each worker and is expected to end up in `serve`. upload(data,
+    extension, content_type) is the coroutine function that uploads attachments for the workers, which have no XMPP
+    connection of their own, and returns their link.
+    """
+
+    def __init__(self, shards: int, target, args: tuple = (), upload=None):
+        self.shards = shards
+        self.upload = upload
+        self.ring = ShardRing(shards)
+        self.target = target
+        self.args = args
+        self.processes = []
+        self.connections = []
+        # request id -> (shard, future, coroutine function taking a reply body and priority)
+        self.pending = {}
+        self.request_ids = itertools.count()
+        self._loop = None
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        # spawn rather than fork, the parent has an event loop and possibly CUDA state that must not be inherited
+        context = multiprocessing.get_context("spawn")
+        self._loop = loop
+        for index in range(self.shards):
+            connection, child_connection = context.Pipe()
+            process = context.Process(target=self.target, args=(index, child_connection) + self.args,
+                                      name=f"shard-{index}", daemon=True)
+            process.start()
+            child_connection.close()
+            self.processes.append(process)
+            self.connections.append(connection)
+            loop.add_reader(connection.fileno(), self._receive, index)
+        log.info(f"Started {len(self.processes)} shard workers")
+
+    def stop(self) -> None:
+        for connection in self.connections:
+            self._loop.remove_reader(connection.fileno())
+            connection.close()
+        for process in self.processes:
+            process.join(timeout=5)
+
+    def _receive(self, index: int) -> None:
+        connection = self.connections[index]
+        try:
+            while connection.poll():
+                message = connection.recv()
+                self._dispatch(message)
+        except (EOFError, OSError):
+            self._loop.remove_reader(connection.fileno())
+            log.error(f"Shard worker {index} went away, its JIDs can not be answered until the bot is restarted")
+            for shard, future, _ in self.pending.values():
+                if shard == index and not future.done():
+                    future.set_exception(ShardError(f"Shard worker {index} went away"))
+
+    def _dispatch(self, message: tuple) -> None:
+        kind, request_id, *payload = message
+        if request_id not in self.pending:
+            # Cancelled in the meantime
+            return None
+        _, future, reply = self.pending[request_id]
+        match kind:
+            case "reply":
+                body, priority = payload
+                asyncio.ensure_future(reply(body, priority))
+            case "upload":
+                asyncio.ensure_future(self._upload(self.pending[request_id][0], *payload))
+            case "done":
+                if not future.done():
+                    future.set_result(payload[0])
+            case "error":
+                if not future.done():
+                    future.set_exception(ShardError(payload[0]))
+
+    async def _upload(self, index: int, upload_id: int, data: bytes, extension: str, content_type: str) -> None:
+        link, error = None, None
+        try:
+            link = await self.upload(data, extension, content_type)
+        except Exception as exn:
+            log.exception(f"Upload for shard worker {index} failed")
+            error = repr(exn)
+        self.connections[index].send(("uploaded", upload_id, link, error))
+
+    async def _request(self, key: str, message: tuple, reply=None):
+        index = self.ring.shard_for(key)
+        request_id = next(self.request_ids)
+        future = self._loop.create_future()
+        self.pending[request_id] = (index, future, reply)
+        self.connections[index].send((message[0], request_id) + message[1:])
+        try:
+            return await future
+        except asyncio.CancelledError:
+            self.connections[index].send(("cancel", request_id))
+            raise
+        finally:
+            del self.pending[request_id]
+
+    async def generate(self, mfrom: JID, mtype: str, prompt: str, reply) -> str:
+        """Runs api_call in the JID's worker, reply(body, priority) is awaited for anything it sends on the way"""
+        return await self._request(mfrom.bare, ("chat", str(mfrom), mtype, prompt), reply)
+
+    async def reset(self, jid: str, persona: str | None = None) -> None:
+        await self._request(jid, ("reset", jid, persona))
+
+
+async def serve(connection, bot) -> None:
+    """Worker process side, runs requests from the front process on bot until the front process goes away"""
+    loop = asyncio.get_running_loop()
+    finished = loop.create_future()
+    tasks = {}
+
+    async def chat(request_id: int, jid: str, mtype: str, prompt: str) -> None:
+        current_request.set(request_id)
+        mfrom = JID(jid)
+        try:
+            if mfrom.bare not in bot.user_sessions:
+                await bot.start_session(mfrom.bare)
+            connection.send(("done", request_id, await bot.api_call(mfrom, mtype, prompt)))
+        except asyncio.CancelledError:
+            pass
+        except Exception as exn:
+            log.exception(f"Generation for {mfrom.bare} failed")
+            connection.send(("error", request_id, repr(exn)))
+        finally:
+            del tasks[request_id]
+
+    async def reset(request_id: int, jid: str, persona: str | None) -> None:
+        try:
+            await bot.start_session(jid, persona)
+            connection.send(("done", request_id, None))
+        except asyncio.CancelledError:
+            pass
+        except Exception as exn:
+            log.exception(f"Resetting the session of {jid} failed")
+            connection.send(("error", request_id, repr(exn)))
+        finally:
+            del tasks[request_id]
+
+    def receive() -> None:
+        try:
+            while connection.poll():
+                kind, request_id, *payload = connection.recv()
+                match kind:
+                    case "chat":
+                        tasks[request_id] = asyncio.ensure_future(chat(request_id, *payload))
+                    case "cancel":
+                        if request_id in tasks:
+                            tasks[request_id].cancel()
+                    case "reset":
+                        tasks[request_id] = asyncio.ensure_future(reset(request_id, *payload))
+                    case "uploaded":
+                        # Carries the upload id in place of a request id
+                        future = uploads.get(request_id)
+                        link, error = payload
+                        if future is not None and not future.done():
+                            if error is None:
+                                future.set_result(link)
+                            else:
+                                future.set_exception(ShardError(error))
+        except (EOFError, OSError):
+            loop.remove_reader(connection.fileno())
+            if not finished.done():
+                finished.set_result(None)
+
+    bot.backends.start_health_checks(bot.get_http_session())
+    bot.start_card_watchers()
+    loop.add_reader(connection.fileno(), receive)
+    await finished
+    for task in list(tasks.values()):
+        task.cancel()
+    if bot.http_session is not None:
+        await bot.http_session.close()
+
+
+async def request_upload(connection, data: bytes, extension: str, content_type: str) -> str:
+    """Has the front process upload an attachment made by the worker's bot and returns its link"""
+    request_id = current_request.get()
+    if request_id is None:
+        raise ShardError("Uploads can only be made while handling a request")
+    upload_id = next(upload_ids)
+    future = asyncio.get_running_loop().create_future()
+    uploads[upload_id] = future
+    connection.send(("upload", request_id, upload_id, data, extension, content_type))
+    try:
+        return await future
+    finally:
+        del uploads[upload_id]
+
+
+def send_reply(connection, body: str, priority: int) -> None:
+    """Hands a reply sent by the worker's bot back to the front process for encryption"""
+    request_id = current_request.get()
+    if request_id is None:
+        log.warning("Dropping a reply sent outside of any request")
+        return None
+    connection.send(("reply", request_id, body, priority))
@@ -18,8 +18,11 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import wave
+from argparse import ArgumentParser
+
 import numpy as np
-from scipy.io.wavfile import write
+
 
 class NoiseGenerator:
     """Generates gaussian noise with a specified power spectral density.
@@ -47,9 +50,17 @@ class NoiseGenerator:
     >>> psds = [0.1, 10.0, 0.01, 0.01, 2.0, 0.001]
     >>> colour = ng.piecewise_logarithmic(frequencies, psds)
     >>> custom = ng.generate(1e-4, 1000000, colour=colour)
+
+    Stream endless brown noise at 24 kHz in blocks of 4096 samples, scaled
+    to an RMS of 0.1, with a reproducible seed.
+
+    >>> ng = NoiseGenerator(seed=1234)
+    >>> blocks = ng.stream(1 / 24000, 4096, colour=ng.brown(), rms=0.1)
+    >>> block = next(blocks)
     """
 
-    rng = np.random.default_rng()
+    def __init__(self, seed=None):
+        self.rng = np.random.default_rng(seed)
 
     def generate(self, dt, n, colour=None):
         """Generates uniformly sampled noise of a particular colour.
@@ -68,15 +79,84 @@ class NoiseGenerator:
         Returns
         -------
         numpy.array
-            Length `n` array of sampled noise.
+            Length `n` float32 array of sampled noise.
         """
 
         f, x_f = self._base_noise(dt, n)
 
         if colour:
-            x_f *= np.sqrt(colour(f))
+            x_f *= np.sqrt(colour(f)).astype(np.float32)
+
+        return np.fft.irfft(x_f, n).astype(np.float32, copy=False)
+
+    def stream(self, dt, block_size, colour=None, rms=None, blocks=None):
+        """Generates noise of a particular colour as a stream of blocks.
+
+        Each frame of ``2 * block_size`` samples is generated independently,
+        shaped with a sine window and overlap-added with its neighbours at
+        50 % overlap. The squared sine windows sum to one, so the power of the
+        uncorrelated frames adds up to a constant and the seams are inaudible.
+        Memory use is constant however long the stream runs, at the cost of
+        the spectrum below ``1 / (2 * block_size * dt)`` Hz.
+
+        Parameters
+        ----------
+        dt : float
+            Sampling period, in seconds.
+        block_size : int
+            Number of samples per block.
+        colour : function, optional
+            Colouring function, see `generate()`.
+        rms : float, optional
+            Scales the noise to this expected RMS level. If not specified the
+            noise is left at the level implied by `colour`.
+        blocks : int, optional
+            Number of blocks to produce. If not specified the stream is
+            endless.
+
+        Yields
+        ------
+        numpy.array
+            Length `block_size` float32 arrays of sampled noise.
+        """
+
+        frame_size = 2 * block_size
+        window = np.sin(np.pi * (np.arange(frame_size) + 0.5) / frame_size).astype(np.float32)
+        if rms is not None:
+            window *= np.float32(rms / self.expected_rms(dt, frame_size, colour))
 
-        return np.fft.irfft(x_f)
+        tail = self.generate(dt, frame_size, colour)[block_size:] * window[block_size:]
+        produced = 0
+        while blocks is None or produced < blocks:
+            frame = self.generate(dt, frame_size, colour) * window
+            yield tail + frame[:block_size]
+            tail = frame[block_size:]
+            produced += 1
+
+    @staticmethod
+    def expected_rms(dt, n, colour=None):
+        """Expected RMS of `n` samples of noise generated with `colour`.
+
+        Parameters
+        ----------
+        dt : float
+            Sampling period, in seconds.
+        n : int
+            Number of samples generated at once.
+        colour : function, optional
+            Colouring function, see `generate()`.
+
+        Returns
+        -------
+        float
+            The square root of the PSD integrated over the frequencies a
+            length `n` transform resolves, which is what the variance of the
+            generated noise converges to.
+        """
+
+        f = np.fft.rfftfreq(n, dt)
+        psd = np.broadcast_to(colour(f) if colour else 1.0, f.shape)
+        return float(np.sqrt(np.sum(psd[1:]) / (n * dt)))
 
     @staticmethod
     def white(scale=1.0):
@@ -219,9 +299,10 @@ class NoiseGenerator:
 
         # Calculate random frequency components
         f = np.fft.rfftfreq(n, dt)
-        x_f = self.rng.normal(0,
-            0.5, len(f)) + 1j * self.rng.normal(0, 0.5, len(f))
-        x_f *= np.sqrt(n / dt)
+        x_f = np.empty(len(f), dtype=np.complex64)
+        x_f.real = self.rng.standard_normal(len(f), dtype=np.float32)
+        x_f.imag = self.rng.standard_normal(len(f), dtype=np.float32)
+        x_f *= np.float32(0.5 * np.sqrt(n / dt))
 
         # Ensure our 0 Hz and Nyquist components are purely real
         x_f[0] = np.abs(x_f[0])
@@ -229,14 +310,27 @@ class NoiseGenerator:
             x_f[-1] = np.abs(x_f[-1])
 
         return f, x_f
-        
-ng = NoiseGenerator()
-sample_rate = 24000
-run_length_in_secs = 90
-volume_level = 1e-4
-data = ng.generate(volume_level, run_length_in_secs*sample_rate, colour=ng.brown(0.1))
-scaled = np.int16(data / np.max(np.abs(data)) * 32767)
 
-amplitude = 30
 
-write('noise.wav', sample_rate, scaled.astype(np.int16))
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Write coloured background noise to a 16 bit mono wav file")
+    parser.add_argument("-o", "--output", dest="output", help="Defaults to noise.wav", default="noise.wav")
+    parser.add_argument("--seconds", dest="seconds", type=float, help="Defaults to 90", default=90)
+    parser.add_argument("--sample-rate", dest="sample_rate", type=int, help="Defaults to 24000", default=24000)
+    parser.add_argument("--colour", dest="colour", help="white, pink, brown, blue or violet. Defaults to brown",
+                        default="brown")
+    parser.add_argument("--rms", dest="rms", type=float, help="RMS level relative to full scale. Defaults to 0.2",
+                        default=0.2)
+    parser.add_argument("--seed", dest="seed", type=int, help="Seed for reproducible noise", default=None)
+    args = parser.parse_args()
+
+    ng = NoiseGenerator(seed=args.seed)
+    block_size = 4096
+    blocks = int(np.ceil(args.seconds * args.sample_rate / block_size))
+    with wave.open(args.output, "wb") as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(args.sample_rate)
+        for block in ng.stream(1 / args.sample_rate, block_size, colour=getattr(ng, args.colour)(),
+                               rms=args.rms, blocks=blocks):
+            file.writeframes((np.clip(block, -1.0, 1.0) * 32767).astype("<i2").tobytes())
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+from collections import deque
+
+
+class StopSequenceDetector:
+    """
+    Incremental multi-pattern matcher (Aho-Corasick) for stop sequences in a streamed response.
+
+    Text is fed in as it arrives from the backend. Everything that can no longer be the start of a stop sequence is
+    released straight away, only the shortest suffix that could still grow into one is held back. Stop sequences
+    split across chunks are found just the same as ones that arrive whole.
+
+    >>> detector = StopSequenceDetector(["<|eot_id|>", "!assistant"])
+    >>> detector.feed("Hello<|eot")
+    'Hello'
+    >>> detector.feed("_id|>ignored")
+    ''
+    >>> detector.stopped, detector.stop_sequence
+    (True, '<|eot_id|>')
+    """
+
+    def __init__(self, stop_sequences: list[str]):
+        # goto function of the trie, one dict per state, state 0 is the root
+        self._goto: list[dict] = [{}]
+        # length of the longest stop sequence that ends in each state, following dictionary suffix links
+        self._match: list[int] = [0]
+        # length of the string spelled out by each state, i.e. how much text has to be held back in it
+        self._depth: list[int] = [0]
+        self._fail: list[int] = [0]
+        for sequence in stop_sequences:
+            if sequence:
+                self._add(sequence)
+        self._build()
+
+        self._state = 0
+        self._pending = ""
+        self.stopped = False
+        self.stop_sequence = None
+
+    def _add(self, sequence: str) -> None:
+        state = 0
+        for char in sequence:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._match.append(0)
+                self._depth.append(self._depth[state] + 1)
+                self._fail.append(0)
+                self._goto[state][char] = next_state
+            state = next_state
+        self._match[state] = len(sequence)
+
+    def _build(self) -> None:
+        # Breadth first so every failure link points at a state that is already finished
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._match[next_state] = max(self._match[next_state], self._match[self._fail[next_state]])
+                queue.append(next_state)
+
+    def _step(self, char: str) -> int:
+        state = self._state
+        while state and char not in self._goto[state]:
+            state = self._fail[state]
+        return self._goto[state].get(char, 0)
+
+    def feed(self, text: str) -> str:
+        """Scans the next chunk and returns the part of the response that is safe to pass on."""
+        if self.stopped:
+            return ""
+        buffer = self._pending + text
+        offset = len(self._pending)
+        for index, char in enumerate(text, start=offset):
+            self._state = self._step(char)
+            length = self._match[self._state]
+            if length:
+                self.stopped = True
+                self.stop_sequence = buffer[index + 1 - length:index + 1]
+                self._pending = ""
+                return buffer[:index + 1 - length]
+
+        held = self._depth[self._state]
+        self._pending = buffer[len(buffer) - held:] if held else ""
+        return buffer[:len(buffer) - held]
+
+    def flush(self) -> str:
+        """Releases whatever was held back once the stream has ended without a stop sequence."""
+        pending = self._pending
+        self._pending = ""
+        self._state = 0
+        return pending
+
+    def scan(self, text: str) -> str:
+        """Applies the stop sequences to a complete, non streamed response."""
+        return self.feed(text) + self.flush()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+import logging
+import secrets
+from argparse import ArgumentParser
+
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+DEFAULT_STUB_TOKENS = 32
+DEFAULT_STUB_TOKEN_RATE = 200.0
+DEFAULT_STUB_LATENCY = 0.0
+DEFAULT_STUB_SLOTS = 4
+STUB_WORDS = ("The quick brown fox jumps over the lazy dog while the llama watches from the upper deck and counts "
+              "tokens one by one until the reply is complete.").split(" ")
+# A page of <p> paragraphs with <code> and <a> tags in them, for the BeautifulSoup extraction of http_request
+STUB_PAGE = "<html><body>" + "".join(
+    f"<p>Paragraph {index} mentions <code>--flag-{index}</code> and <a href='#{index}'>a link</a>. "
+    f"{' '.join(STUB_WORDS)}</p>" for index in range(50)) + "</body></html>"
+
+
+class StubBackend:
+    """
+    A stand-in for a llama.cpp, kobold.cpp or OpenAI compatible server. Every prompt is answered with filler text,
+    the first token after `latency` seconds and the rest at `token_rate` tokens per second.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, tokens: int = DEFAULT_STUB_TOKENS,
+                 token_rate: float = DEFAULT_STUB_TOKEN_RATE, latency: float = DEFAULT_STUB_LATENCY,
+                 slots: int = DEFAULT_STUB_SLOTS):
+        self.host = host
+        self.port = port
+        self.tokens = tokens
+        self.token_rate = token_rate
+        self.latency = latency
+        self.requests = 0
+        self.slots = slots
+        # llama.cpp slot save/restore calls, as (slot, action, filename)
+        self.slot_actions = []
+        # kobold.cpp genkey -> text generated so far
+        self.in_flight = {}
+        self.app = web.Application()
+        self.app.router.add_get("/health", self.health)
+        self.app.router.add_post("/completion", self.completion)
+        self.app.router.add_get("/slots", self.list_slots)
+        self.app.router.add_post("/slots/{slot}", self.slot_action)
+        self.app.router.add_get("/api/extra/version", self.version)
+        self.app.router.add_post("/api/v1/generate", self.kobold_generate)
+        self.app.router.add_post("/api/extra/generate/check", self.kobold_check)
+        self.app.router.add_post("/api/extra/abort", self.kobold_abort)
+        self.app.router.add_post("/v1/chat/completions", self.chat_completions)
+        self.app.router.add_get("/v1/models", self.models)
+        self.app.router.add_get("/page", self.page)
+        self._runner = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def token_delay(self) -> float:
+        return 1 / self.token_rate if self.token_rate > 0 else 0.0
+
+    async def start(self) -> str:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        # port 0 lets the OS pick a free one
+        self.port = site._server.sockets[0].getsockname()[1]
+        log.info(f"Stub backend listening on {self.url}")
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def generate(self, n_predict: int) -> list[str]:
+        count = self.tokens if n_predict is None or n_predict < 0 else min(n_predict, self.tokens)
+        return [STUB_WORDS[index % len(STUB_WORDS)] + " " for index in range(count)]
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({"status": "ok"})
+
+    async def list_slots(self, request: web.Request) -> web.Response:
+        return web.json_response([{"id": slot, "is_processing": False} for slot in range(self.slots)])
+
+    async def slot_action(self, request: web.Request) -> web.Response:
+        slot = int(request.match_info["slot"])
+        action = request.query.get("action")
+        body = await request.json() if action in ("save", "restore") else {}
+        if slot >= self.slots or action not in ("save", "restore", "erase"):
+            return web.json_response({"error": {"code": 400, "message": "Invalid slot or action"}}, status=400)
+        self.slot_actions.append((slot, action, body.get("filename")))
+        return web.json_response({"id_slot": slot, "filename": body.get("filename")})
+
+    async def version(self, request: web.Request) -> web.Response:
+        return web.json_response({"result": "KoboldCpp", "version": "stub"})
+
+    async def page(self, request: web.Request) -> web.Response:
+        return web.Response(text=STUB_PAGE, content_type="text/html")
+
+    async def completion(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.json()
+        tokens = self.generate(body.get("n_predict"))
+        await asyncio.sleep(self.latency)
+
+        if not body.get("stream"):
+            await asyncio.sleep(self.token_delay * len(tokens))
+            return web.json_response({"content": "".join(tokens), "stop": True, "tokens_predicted": len(tokens)})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        try:
+            for token in tokens:
+                await response.write(f"data: {json.dumps({'content': token, 'stop': False})}\n\n".encode("utf-8"))
+                await asyncio.sleep(self.token_delay)
+            await response.write(f"data: {json.dumps({'content': '', 'stop': True})}\n\n".encode("utf-8"))
+        except ConnectionResetError:
+            # The client hung up early, e.g. on a stop sequence or a cancelled generation
+            pass
+        return response
+
+    async def models(self, request: web.Request) -> web.Response:
+        return web.json_response({"object": "list", "data": [{"id": "stub", "object": "model"}]})
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.json()
+        tokens = self.generate(body.get("max_tokens"))
+        await asyncio.sleep(self.latency)
+
+        if not body.get("stream"):
+            await asyncio.sleep(self.token_delay * len(tokens))
+            return web.json_response({"object": "chat.completion", "model": "stub", "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}]})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        try:
+            for token in tokens:
+                chunk = {"object": "chat.completion.chunk", "model": "stub",
+                         "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+                await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                await asyncio.sleep(self.token_delay)
+            chunk = {"object": "chat.completion.chunk", "model": "stub",
+                     "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+        except ConnectionResetError:
+            pass
+        return response
+
+    async def kobold_generate(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        body = await request.json()
+        genkey = body.get("genkey") or secrets.token_hex(4)
+        self.in_flight[genkey] = ""
+        try:
+            await asyncio.sleep(self.latency)
+            for token in self.generate(body.get("max_length")):
+                if genkey not in self.in_flight:
+                    # Aborted, kobold.cpp still answers with what it had
+                    break
+                self.in_flight[genkey] += token
+                await asyncio.sleep(self.token_delay)
+            return web.json_response({"results": [{"text": self.in_flight.get(genkey, "")}]})
+        finally:
+            self.in_flight.pop(genkey, None)
+
+    async def kobold_check(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response({"results": [{"text": self.in_flight.get(body.get("genkey"), "")}]})
+
+    async def kobold_abort(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        return web.json_response({"success": self.in_flight.pop(body.get("genkey"), None) is not None})
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Serve canned completions in place of a llama.cpp, kobold.cpp or OpenAI "
+                                        "compatible server")
+    parser.add_argument("--host", dest="host", help="Address to listen on. Defaults to 127.0.0.1",
+                        default="127.0.0.1")
+    parser.add_argument("--port", dest="port", type=int, help="Port to listen on. Defaults to 8080",
+                        default=8080)
+    parser.add_argument("--tokens", dest="tokens", type=int,
+                        help="Tokens in every response. Defaults to %d" % DEFAULT_STUB_TOKENS,
+                        default=DEFAULT_STUB_TOKENS)
+    parser.add_argument("--token-rate", dest="token_rate", type=float,
+                        help="Tokens generated per second. Defaults to %d" % DEFAULT_STUB_TOKEN_RATE,
+                        default=DEFAULT_STUB_TOKEN_RATE)
+    parser.add_argument("--latency", dest="latency", type=float,
+                        help="Seconds of prompt processing before the first token. Defaults to 0",
+                        default=DEFAULT_STUB_LATENCY)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(levelname)-8s %(message)s')
+
+    stub = StubBackend(args.host, args.port, args.tokens, args.token_rate, args.latency)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(stub.start())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        loop.run_until_complete(stub.stop())
@@ -8,14 +8,19 @@ import TTS.TTS.utils.audio
 from TTS.tts.configs.xtts_config import XttsConfig
 from TTS.tts.models.xtts import Xtts
 from TTS.config import BaseAudioConfig
+from transformers.pytorch_utils import Conv1D
 import os
 import sys
 import re
+import time
 import TTS.TTS.utils.audio.processor
 from pydub import AudioSegment
 from scipy.io import wavfile
 import numpy
 
+import metrics
+from mixer import Mixer
+
 script_dir = sys.argv[0].split("/")[:-1]
 full_path = ""
 for path_part in script_dir[1:]:
@@ -50,6 +55,30 @@ default_rule_list = [["...", "."],
                      ["9.", "9 "]]
 
 
+WARM_UP_TEXT = "Warming up the voice."
+# GPT tokens decoded per streamed chunk, about a fifth of a second of speech
+DEFAULT_STREAM_CHUNK_SIZE = 20
+
+
+def linearize(module: torch.nn.Module) -> int:
+    """
+    Swaps the GPT-2 style Conv1D layers of the XTTS GPT for the equivalent nn.Linear, which is what dynamic
+    quantization knows how to quantize. Returns how many layers were swapped.
+    """
+    swapped = 0
+    for name, child in module.named_children():
+        if isinstance(child, Conv1D):
+            # Conv1D keeps its weight as (in, out), Linear as (out, in)
+            linear = torch.nn.Linear(child.weight.shape[0], child.weight.shape[1])
+            linear.weight = torch.nn.Parameter(child.weight.detach().t().contiguous(), requires_grad=False)
+            linear.bias = torch.nn.Parameter(child.bias.detach(), requires_grad=False)
+            setattr(module, name, linear)
+            swapped += 1
+        else:
+            swapped += linearize(child)
+    return swapped
+
+
 def nearest_space(text, index):
     space_index = text.rfind(' ', 0, index)  # Find the last space before the given index
     if space_index == -1:  # If no space is found before the index
@@ -67,14 +96,23 @@ class TTSAudioController:
                  repetition_penalty: float = 2.3,
                  gpt_cond_len: int = 999999,
                  pitch_fmax: int = 640,
-                 pitch_fmin: int = 1):
+                 pitch_fmin: int = 1,
+                 mixer: Mixer = None,
+                 device: str = None,
+                 quantize: bool = False,
+                 threads: int = None,
+                 warm_up_speaker: str = None):
 
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = device if device is not None else "cuda" if torch.cuda.is_available() else "cpu"
+        if threads is not None:
+            torch.set_num_threads(threads)
         self.config = XttsConfig()
         self.config.load_json(full_path + "XTTS-v2/config.json")
         self.model = Xtts.init_from_config(self.config)
         self.model.load_checkpoint(self.config, checkpoint_dir=full_path + "XTTS-v2/", eval=True)
-        self.model.cuda()
+        self.model.to(self.device)
+        if quantize:
+            self.quantize()
         self.conf = BaseAudioConfig(pitch_fmax=pitch_fmax, pitch_fmin=pitch_fmin)
         self.ap = TTS.TTS.utils.audio.AudioProcessor(**self.conf)
         self.top_k = top_k
@@ -82,15 +120,93 @@ class TTSAudioController:
         self.temperature = temperature
         self.repetition_penalty = repetition_penalty
         self.gpt_cond_len = gpt_cond_len
+        self.mixer = mixer if mixer is not None else Mixer()
+        # (reference wav, mtime) of each voice -> GPT conditioning latent and speaker embedding
+        self.conditioning = {}
+        if warm_up_speaker is not None:
+            # The first synthesis pays for lazy initialisation and allocator growth, better at load than on a reply
+            self.synthesize(WARM_UP_TEXT, [warm_up_speaker])
+
+    def quantize(self) -> None:
+        """
+        Dynamic int8 quantization of the linear layers of the GPT and the decoder, for CPU inference. Weights are
+        stored as int8 and activations quantized on the fly, which roughly halves the time spent in matrix multiplies.
+        """
+        if self.device != "cpu":
+            raise ValueError("Dynamic quantization only runs on the CPU")
+        swapped = linearize(self.model.gpt)
+        for name in ("gpt", "hifigan_decoder"):
+            torch.ao.quantization.quantize_dynamic(getattr(self.model, name), {torch.nn.Linear}, dtype=torch.qint8,
+                                                   inplace=True)
+        logging.info(f'Quantized the XTTS linear layers to int8, {swapped} GPT-2 Conv1D layers were converted')
+
+    def latents(self, speakers: list) -> tuple:
+        """
+        Conditioning latents of a voice, computed from its reference audio once rather than for every sentence as
+        Xtts.synthesize does. A reference file that changes on disk is picked up again.
+        """
+        key = tuple((speaker, os.stat(speaker).st_mtime_ns) for speaker in speakers)
+        latents = self.conditioning.get(key)
+        if latents is None:
+            with torch.inference_mode():
+                latents = self.model.get_conditioning_latents(audio_path=speakers,
+                                                              gpt_cond_len=self.gpt_cond_len,
+                                                              gpt_cond_chunk_len=self.config.gpt_cond_chunk_len,
+                                                              max_ref_length=self.config.max_ref_len,
+                                                              sound_norm_refs=self.config.sound_norm_refs)
+            self.conditioning[key] = latents
+        return latents
+
+    def synthesize(self, sentence: str, speakers: list) -> numpy.ndarray:
+        """One sentence as a float32 waveform"""
+        gpt_cond_latent, speaker_embedding = self.latents(speakers)
+        with torch.inference_mode():
+            outputs = self.model.inference(sentence,
+                                           "en",
+                                           gpt_cond_latent,
+                                           speaker_embedding,
+                                           top_k=self.top_k,
+                                           top_p=self.top_p,
+                                           temperature=self.temperature,
+                                           repetition_penalty=self.repetition_penalty,
+                                           do_sample=True)
+        return numpy.asarray(outputs['wav'], dtype=numpy.float32)
+
+    def stream(self, sentence: str, speakers: list, chunk_size: int = DEFAULT_STREAM_CHUNK_SIZE):
+        """
+        Yields one sentence as float32 waveform chunks while the decoder produces them. Only the benchmark uses it, to
+        measure the time to the first chunk, replies are spoken whole sentences at a time by run_model.
+        """
+        gpt_cond_latent, speaker_embedding = self.latents(speakers)
+        chunks = self.model.inference_stream(sentence,
+                                             "en",
+                                             gpt_cond_latent,
+                                             speaker_embedding,
+                                             stream_chunk_size=chunk_size,
+                                             top_k=self.top_k,
+                                             top_p=self.top_p,
+                                             temperature=self.temperature,
+                                             repetition_penalty=self.repetition_penalty,
+                                             do_sample=True)
+        start = time.perf_counter()
+        first = True
+        while True:
+            # inference_mode is entered around each step only, so it does not leak into whoever consumes the chunks
+            with torch.inference_mode():
+                chunk = next(chunks, None)
+            if chunk is None:
+                return None
+            if first:
+                metrics.observe("tts_first_chunk", time.perf_counter() - start)
+                first = False
+            yield chunk.cpu().numpy().astype(numpy.float32)
 
-    def run_model(self, sentences: list, speakers: list, offset: int = 1):
+    def run_model(self, sentences: list, speakers: list, offset: int = 1) -> bytes:
+        """Speaks the sentences and returns them as one mp3"""
         for speaker in speakers:
             if not os.path.exists(speaker):
                 raise FileNotFoundError(f'Path to speaker {speaker} not found.')
                 exit(1)
-        metadata_path = f'{full_path}staging/metadata.txt'
-        # os.remove(metadata_path)
-        os.system(f'cp /dev/null {metadata_path}')
 
         for index, sentence in enumerate(sentences):
             if len(sentence) > 250:
@@ -102,29 +218,17 @@ class TTSAudioController:
                     f'The sentence "{sentence[0:50]}...." exceeded the recommended length of 250 characters and has '
                     f'been split into two separate sentences')
 
+        # Waveforms stay in memory, the mixer lays them out and ffmpeg encodes the result in one pass
+        waveforms = []
         for index, sentence in enumerate(sentences):
             try:
-                outputs = self.model.synthesize(text=sentence,
-                                                config=self.config,
-                                                speaker_wav=speakers,
-                                                language="en",
-                                                top_k=self.top_k,
-                                                top_p=self.top_p,
-                                                temperature=self.temperature,
-                                                repetition_penalty=self.repetition_penalty,
-                                                do_sample=True,
-                                                gpt_cond_len=self.gpt_cond_len)
+                with metrics.span("tts_sentence"):
+                    waveforms.append(self.synthesize(sentence, speakers))
             except AssertionError:
                 logging.warning(f'WARNING: Sentence "{sentence[0:50]}...." was too long and was skipped')
-                pass
-            file_name = f'{"0000000"[:-len(str(index + offset))] + str(index + offset)}'
-            file_path = f'{full_path}staging/{file_name}.wav'
-
-            with open(metadata_path, "a") as f:
-                f.write(f'file {file_name}.wav\nfile {file_name}-s.wav\n')
-                os.system(f'cp {full_path}audio_processing/silence.wav {full_path}staging/{file_name}-s.wav')
-            self.ap.save_wav(wav=outputs['wav'], path=file_path, sr=24000)
-        os.system(f'ffmpeg -y -loglevel error -f concat -i  {metadata_path} {full_path}final.mp3')
+                continue
+        with metrics.span("tts_concat"):
+            return self.mixer.encode(waveforms)
 class TTSTextProcessor:
     def preprocess_text(self, input_text, rules_list):
         for rule in rules_list:
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import os
+from collections.abc import AsyncIterable
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from slixmpp.plugins.xep_0363 import FileTooBig, HTTPError, UploadServiceNotFound
+from slixmpp.plugins.xep_0454 import XEP_0454
+
+log = logging.getLogger(__name__)
+
+DEFAULT_UPLOAD_CONCURRENCY = 4
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# AES-GCM ciphertext is as long as the plaintext, the tag is appended to the file
+TAG_SIZE = 16
+
+
+class Uploader:
+    """
+    Encrypted HTTP uploads as in XEP-0454, straight from memory. Compared to the xep_0454 plugin nothing is written to
+    or read back from disk, data is encrypted chunk by chunk while it is sent instead of all at once beforehand, and
+    every PUT goes through the bot's pooled HTTP session. Up to concurrency uploads run at the same time.
+    """
+
+    def __init__(self, xmpp, get_http_session, concurrency: int = DEFAULT_UPLOAD_CONCURRENCY,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.xmpp = xmpp
+        self.get_http_session = get_http_session
+        self.chunk_size = chunk_size
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self._discovery_lock = asyncio.Lock()
+
+    async def discover(self):
+        """The upload service of our server, looked up once and stored where the xep_0363 plugin keeps it"""
+        http_upload = self.xmpp['xep_0363']
+        # Concurrent first uploads wait for the same lookup
+        async with self._discovery_lock:
+            if http_upload.upload_service is not None:
+                return http_upload.upload_service
+            info = await http_upload.find_upload_service()
+            if info is None:
+                raise UploadServiceNotFound()
+            for form in info['disco_info'].iterables:
+                values = form['values']
+                if values['FORM_TYPE'] == ['urn:xmpp:http:upload:0']:
+                    try:
+                        http_upload.max_file_size = int(values['max-file-size'])
+                    except (TypeError, ValueError):
+                        log.error('Invalid max size received from HTTP File Upload service')
+                    break
+            http_upload.upload_service = info['from']
+            return http_upload.upload_service
+
+    async def upload(self, data: bytes | AsyncIterable[bytes], extension: str, content_type: str,
+                     size: int | None = None) -> str:
+        """
+        Uploads bytes or an async stream of bytes and returns the aesgcm:// URL to share. The slot has to be asked for
+        with the size of the file, so a stream is gathered in memory first unless its size is given.
+        """
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            size = len(data)
+        elif size is None:
+            buffer = bytearray()
+            async for chunk in data:
+                buffer += chunk
+            data = buffer
+            size = len(data)
+        async with self.semaphore:
+            http_upload = self.xmpp['xep_0363']
+            service = await self.discover()
+            if size + TAG_SIZE > http_upload.max_file_size:
+                raise FileTooBig(size + TAG_SIZE, http_upload.max_file_size)
+            # Random name, the plaintext name would leak through the URL
+            filename = f"{os.urandom(12).hex()}.{XEP_0454.map_extensions(extension)}"
+            slot_iq = await http_upload.request_slot(service, filename, size + TAG_SIZE, content_type)
+            slot = slot_iq['http_upload_slot']
+            key = os.urandom(32)
+            iv = os.urandom(12)
+            headers = {
+                'Content-Length': str(size + TAG_SIZE),
+                'Content-Type': content_type,
+                **{header['name']: header['value'] for header in slot['put']['headers']}
+            }
+            async with self.get_http_session().put(slot['put']['url'], data=self.encrypt(data, key, iv),
+                                                   headers=headers) as response:
+                if response.status >= 400:
+                    raise HTTPError(response.status, await response.text())
+            return XEP_0454.format_url(slot['get']['url'], iv.hex() + key.hex())
+
+    async def encrypt(self, data: bytes | AsyncIterable[bytes], key: bytes, iv: bytes):
+        encryptor = Cipher(algorithms.AES(key), modes.GCM(iv)).encryptor()
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            view = memoryview(data)
+            for offset in range(0, len(view), self.chunk_size):
+                yield encryptor.update(view[offset:offset + self.chunk_size])
+        else:
+            async for chunk in data:
+                yield encryptor.update(chunk)
+        yield encryptor.finalize() + encryptor.tag